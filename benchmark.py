@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scalability benchmark for check_archived.py, run against the fake_aterm.py stand-in instead of the UNSW Data Archive.
+
+For each number of files, generates a synthetic local tree and a matching archive with some files missing, with
+mismatching checksums or not yet offline, then runs check_archived.py on it in a new process and reports files/second,
+remote calls per file, peak memory and whether the summary counts are the expected ones.
+
+Usage: python benchmark.py [options]
+e.g.   python benchmark.py --files 1000,10000,100000 --latency 0.005 --check_options "--bulk --sessions 4 --remote_workers 4"
+       python benchmark.py --crc_check
+
+Change log:
+v0.3 added --crc_check
+v0.2 added --hang_rate
+v0.1 first version
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import tempfile
+import subprocess
+
+import fake_aterm
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RDMP_ID = 'D0000000'
+
+def makeTree(workdir, files, files_per_folder, size, fractions, seed):
+    """
+    Write files under workdir/local/project and the manifest of the fake archive. Returns the local folder, the
+    path_subtract to use and the expected number of failing files.
+    """
+    rng = random.Random(seed)
+    path_subtract = os.path.join(workdir, 'local', '')
+    folder = os.path.join(path_subtract, 'project')
+    failures = [0]
+    def assets():
+        for i in range(files):
+            subfolder = os.path.join('project', 'd%05d' % (i // files_per_folder))
+            if i % files_per_folder == 0:
+                os.makedirs(os.path.join(path_subtract, subfolder))
+            name = 'file%07d.dat' % i
+            kind = rng.random()
+            data = b''
+            if kind >= fractions['empty']:
+                data = os.urandom(size)
+            with open(os.path.join(path_subtract, subfolder, name), 'wb') as f:
+                f.write(data)
+            csum = '%x' % (zlib.crc32(data) & 0xffffffff)
+            tape = 'true' if data else None
+            kind = rng.random()
+            if kind < fractions['missing']:
+                failures[0] += 1
+                continue
+            kind -= fractions['missing']
+            if kind < fractions['mismatch']:
+                failures[0] += 1
+                csum = '%x' % ((int(csum, 16) + 1) & 0xffffffff)
+            elif data and kind - fractions['mismatch'] < fractions['online']:
+                failures[0] += 1
+                tape = 'false'
+            yield ('/UNSW_RDS/' + RDMP_ID + '/' + subfolder + '/' + name, csum, len(data), tape)
+    fake_aterm.makeManifest(os.path.join(workdir, 'manifest.sqlite'), assets())
+    return folder, path_subtract, failures[0]
+
+def makeConfig(workdir, settings):
+    ## config.cfg with the fake archive settings, an empty aterm.jar and a "java" script running fake_aterm.py
+    config_path = os.path.join(workdir, 'config')
+    os.mkdir(config_path)
+    with open(os.path.join(config_path, 'config.cfg'), 'w') as f:
+        f.write('fake.manifest=' + os.path.join(workdir, 'manifest.sqlite') + '\n')
+        f.write('fake.log=' + os.path.join(workdir, 'calls.log') + '\n')
+        for name in sorted(settings):
+            f.write('fake.' + name + '=' + str(settings[name]) + '\n')
+    open(os.path.join(config_path, 'aterm.jar'), 'w').close()
+    bin_path = os.path.join(workdir, 'bin')
+    os.mkdir(bin_path)
+    with open(os.path.join(bin_path, 'java'), 'w') as f:
+        f.write('#!/bin/sh\nexec "' + sys.executable + '" "' + os.path.join(HERE, 'fake_aterm.py') + '" "$@"\n')
+    os.chmod(os.path.join(bin_path, 'java'), 0o755)
+    return config_path, bin_path
+
+def runCheck(workdir, folder, path_subtract, config_path, bin_path, check_options):
+    """
+    Run check_archived.py in a new process, returning seconds taken, peak memory in MB, remote calls and the
+    (passed, failed) counts from the .tdt summary.
+    """
+    prefix = os.path.join(workdir, 'report')
+    log = os.path.join(workdir, 'calls.log')
+    open(log, 'w').close()
+    argv = ['check_archived.py', prefix, folder, '--rdmp_id', RDMP_ID, '--config_path', config_path, '--path_subtract', path_subtract] + check_options
+    ## Peak memory is measured inside the child, so it doesn't include the fake archive processes
+    code = ('import sys, resource, runpy\n'
+            'sys.argv = ' + repr(argv) + '\n'
+            'try:\n'
+            '    runpy.run_path(' + repr(os.path.join(HERE, 'check_archived.py')) + ', run_name="__main__")\n'
+            'finally:\n'
+            '    sys.stderr.write("BENCHMARK_MAXRSS %d\\n" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n')
+    env = dict(os.environ)
+    env['PATH'] = bin_path + os.pathsep + env.get('PATH', '')
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    out, err = process.communicate()
+    seconds = time.time() - start
+    maxrss = re.search(r'BENCHMARK_MAXRSS (\d+)', err)
+    ## Exit status 1 only means some files are NOT backed up
+    if process.returncode not in (0, 1) or maxrss is None:
+        raise RuntimeError('check_archived.py failed:\n' + out + err)
+    ## ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_mb = int(maxrss.group(1)) / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+    with open(log) as f:
+        calls = len([line for line in f if fake_aterm.SENTINEL not in line])
+    with open(prefix + '.tdt') as f:
+        summary = f.read()
+    passed = re.search(r'^(\d+) files are backed up', summary, re.M)
+    failed = re.search(r'^(\d+) files are NOT backed up', summary, re.M)
+    if passed is None or failed is None:
+        raise RuntimeError('No summary in ' + prefix + '.tdt:\n' + summary)
+    if process.returncode != (1 if int(failed.group(1)) else 0):
+        raise RuntimeError('check_archived.py exited with ' + str(process.returncode) + ' but ' + failed.group(1) + ' files are NOT backed up')
+    return seconds, peak_mb, calls, int(passed.group(1)), int(failed.group(1))
+
+def crcCheck(workdir):
+    """
+    Compare the checksums localCrc() in check_archived.py calculates in one pass and in parallel chunks with zlib.crc32()
+    of the whole file. The buffer and chunk sizes are made small, so files of a few KB cover every boundary between
+    buffers and chunks. Returns the number of mismatches.
+    """
+    import check_archived
+    check_archived.CRC_BUFFER_SIZE = 1000
+    check_archived.CRC_CHUNK_SIZE = 4096
+    check_dir = tempfile.mkdtemp(prefix='check_archived_crc_', dir=workdir)
+    mismatches = 0
+    try:
+        path = os.path.join(check_dir, 'file.dat')
+        print('%10s %10s %10s  %s' % ('bytes', 'threads', 'crc', 'result'))
+        for size in [0, 1, 999, 1000, 1001, 4095, 4096, 4097, 3 * 4096 + 17, 50000]:
+            data = os.urandom(size)
+            with open(path, 'wb') as f:
+                f.write(data)
+            expected = '%X' % (zlib.crc32(data) & 0xffffffff)
+            ## 1 thread is the single pass, the others split the file into chunks from 1 byte
+            for crc_threads in [1, 2, 3, 8]:
+                crc = check_archived.localCrc(path, 1, crc_threads)
+                if crc != expected:
+                    mismatches += 1
+                print('%10d %10d %10s  %s' % (size, crc_threads, crc, 'OK' if crc == expected else 'expected ' + expected))
+    finally:
+        shutil.rmtree(check_dir)
+    return mismatches
+
+def main(sizes, files_per_folder, size, fractions, settings, check_options, repeat, workdir, keep, json_path, seed):
+    results = []
+    print('%10s %4s %10s %10s %12s %10s %10s  %s' % ('files', 'run', 'seconds', 'files/s', 'calls/file', 'peak MB', 'failed', 'counts'))
+    for files in sizes:
+        run_dir = tempfile.mkdtemp(prefix='check_archived_benchmark_', dir=workdir)
+        try:
+            folder, path_subtract, expected_failures = makeTree(run_dir, files, files_per_folder, size, fractions, seed)
+            config_path, bin_path = makeConfig(run_dir, settings)
+            for run in range(1, repeat + 1):
+                seconds, peak_mb, calls, passed, failed = runCheck(run_dir, folder, path_subtract, config_path, bin_path, check_options)
+                ok = passed + failed == files and failed == expected_failures
+                result = {'files': files, 'run': run, 'seconds': seconds, 'files_per_second': files / seconds, 'remote_calls_per_file': calls / float(files),
+                          'peak_mb': peak_mb, 'passed': passed, 'failed': failed, 'expected_failed': expected_failures, 'counts_ok': ok}
+                results.append(result)
+                print('%10d %4d %10.2f %10.1f %12.3f %10.1f %10d  %s' % (files, run, seconds, result['files_per_second'], result['remote_calls_per_file'], peak_mb, failed, 'OK' if ok else 'expected %d failed' % expected_failures))
+                sys.stdout.flush()
+        finally:
+            if keep:
+                print('Kept ' + run_dir)
+            else:
+                shutil.rmtree(run_dir)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'check_options': check_options, 'settings': settings, 'results': results}, f, indent=2)
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    import shlex
+    usage = "usage: python benchmark.py [options]"
+    parser = OptionParser(usage)
+    parser.add_option("--files", action="store", type="str", dest="files", help="Comma separated numbers of files to benchmark, default='1000,10000'", default='1000,10000')
+    parser.add_option("--files_per_folder", action="store", type="int", dest="files_per_folder", help="Number of files in each generated folder, default=100", default=100)
+    parser.add_option("--size", action="store", type="int", dest="size", help="Size of each generated file in bytes, default=1024", default=1024)
+    parser.add_option("--empty", action="store", type="float", dest="empty", help="Fraction of empty files, default=0.01", default=0.01)
+    parser.add_option("--missing", action="store", type="float", dest="missing", help="Fraction of files missing from the archive, default=0.01", default=0.01)
+    parser.add_option("--mismatch", action="store", type="float", dest="mismatch", help="Fraction of files with a different checksum on the archive, default=0.01", default=0.01)
+    parser.add_option("--online", action="store", type="float", dest="online", help="Fraction of files not yet committed to tape, default=0.01", default=0.01)
+    parser.add_option("--latency", action="store", type="float", dest="latency", help="Seconds the fake archive waits before each reply, default=0", default=0)
+    parser.add_option("--startup", action="store", type="float", dest="startup", help="Seconds the fake archive waits when starting, like JVM startup, default=0", default=0)
+    parser.add_option("--failure_rate", action="store", type="float", dest="failure_rate", help="Fraction of remote commands that fail, default=0", default=0)
+    parser.add_option("--hang_rate", action="store", type="float", dest="hang_rate", help="Fraction of remote commands that never reply, default=0", default=0)
+    parser.add_option("--crash_rate", action="store", type="float", dest="crash_rate", help="Fraction of remote commands that make an aterm session exit, default=0", default=0)
+    parser.add_option("--check_options", action="store", type="str", dest="check_options", help="Extra options for check_archived.py, e.g. '--bulk --sessions 4', default=''", default='')
+    parser.add_option("--repeat", action="store", type="int", dest="repeat", help="Number of runs on each tree, to see the effect of the checksum cache and ledger, default=1", default=1)
+    parser.add_option("--workdir", action="store", type="str", dest="workdir", help="Folder to generate trees in, default is the system temporary folder", default=None)
+    parser.add_option("--keep", action="store_true", dest="keep", help="Keep the generated trees and reports", default=False)
+    parser.add_option("--json", action="store", type="str", dest="json_path", help="Also write the results to this JSON file", default='')
+    parser.add_option("--crc_check", action="store_true", dest="crc_check", help="Only check that local checksums in one pass and in parallel chunks match zlib.crc32 of the whole file", default=False)
+    parser.add_option("--seed", action="store", type="int", dest="seed", help="Random seed for the generated trees, default=1", default=1)
+    (options, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.error(usage)
+    if options.crc_check:
+        sys.exit(1 if crcCheck(options.workdir) else 0)
+    sizes = [int(files) for files in options.files.split(',')]
+    fractions = {'empty': options.empty, 'missing': options.missing, 'mismatch': options.mismatch, 'online': options.online}
+    settings = {'latency': options.latency, 'startup': options.startup, 'failure_rate': options.failure_rate, 'hang_rate': options.hang_rate, 'crash_rate': options.crash_rate}
+    main(sizes, options.files_per_folder, options.size, fractions, settings, shlex.split(options.check_options), options.repeat, options.workdir, options.keep, options.json_path, options.seed)
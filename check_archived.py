@@ -4,6 +4,20 @@
 Given a local folder, path to remote folder, path to config and aterm files, check offline status and checksum for every file.
 
 Change log:
+v0.27 export the remote folder's metadata to a snapshot in one bulk pass and check against it without contacting the archive, listing files only on the archive (--snapshot, --export_snapshot), added Snapshot class
+v0.26 retry transient archive errors with exponential backoff and jitter, time out requests and stop sending them while the archive is down (--max_in_flight, --request_timeout, --retries, --retry_delay, --breaker_threshold, --breaker_cooldown), report requests that failed after retries separately, added AtermError and CircuitBreaker classes
+v0.25 add --fail_fast to stop at the first file NOT backed up, checking remote size and tape status before reading the local file, main() returns whether the folder is safe to delete, exit status 1 if it isn't and 2 if it can't be checked
+v0.24 time each stage of checking files (--profile, --profile_json) and print progress lines with files/s and an ETA (--progress_interval, --count_files), added Profiler and Progress classes
+v0.23 add fake_aterm.py stand-in for aterm and benchmark.py to measure scalability without the Data Archive
+v0.22 walk folders with scandir in parallel threads (--walk_threads), stat each file once, added --include and --exclude options
+v0.21 write results as they are found to prefix.jsonl or prefix.csv (--report_format) and build the .tdt from temporary files instead of lists in memory, added Report class
+v0.20 keep a ledger of files verified offline so reruns skip them while they are unchanged (--ledger, --no_ledger, --ledger_days, --reverify, --reverify_fraction), added OfflineLedger class
+v0.19 cache local checksums between runs in a SQLite file keyed by inode, size and modification time (--crc_cache, --no_crc_cache, --crc_cache_days), added CrcCache class
+v0.18 overlap walking, remote commands and local checksums in a pipeline (--remote_workers, --hash_processes, --queue_size), added orderedMap() function
+v0.17 checksum big files in parallel chunks (--large_file_size, --crc_threads), added crc32Combine() function
+v0.16 calculate local CRC32 in python with zlib instead of calling crc32, rhash or cksum for every file, added localCrc() function
+v0.15 add --bulk option to fetch remote metadata with one asset.query per folder instead of three commands per file
+v0.14 run remote commands through long-lived aterm sessions (--sessions) instead of a new JVM per call, added AtermPool class
 v0.13.7 fix IndexError crash
 v0.13.6 pass errors out with sanity checks (and verbose), added printErrExit() function
 v0.13.5 bug fix to IndexError reporting
@@ -42,7 +56,6 @@ False positives that I can't replicate in smaller examples
 
 TODO:
 do sanity checking of crc results?
-add Archive::Zip module for Perl option? See man crc32
 add other date options?
   specific date and time?
   most recent Saturday midnight?
@@ -58,6 +71,57 @@ import sys
 import platform
 from datetime import timedelta
 import time
+import atexit
+import io
+import threading
+import zlib
+import sqlite3
+import random
+import json
+import csv
+import tempfile
+import math
+import array
+import fnmatch
+import stat
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from os import scandir
+except ImportError:
+    ## Python 2 needs the scandir package, otherwise folders are listed with os.listdir()
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+## Harmless command sent after every command in a session, so the end of each reply can be found
+ATERM_SENTINEL = '/check_archived_end_of_reply'
+SAFE_TOKEN = re.compile(r'^[\w:./=-]+$')
+## aterm error output that is worth retrying, as the archive or the connection to it is having problems
+TRANSIENT_ERRORS = re.compile(r'connection (refused|reset|closed|failed|lost|timed out)|timed out|temporarily unavailable|service unavailable|reset by peer|broken pipe|network is unreachable|server is busy|too many (connections|requests|sessions)', re.I)
+## Longest wait in seconds between retries of a request
+MAX_RETRY_DELAY = 60
+## Number of assets fetched by each query of --export_snapshot
+SNAPSHOT_PAGE_SIZE = 10000
+## Size of the reusable buffer each thread reads files into for checksums
+CRC_BUFFER_SIZE = 4 * 1024 * 1024
+## Files checksummed in parallel are split into ranges of this size
+CRC_CHUNK_SIZE = 256 * 1024 * 1024
+crc_buffers = threading.local()
+## Metadata fetched for every asset by --bulk, as (element name in reply, xpath)
+BULK_XPATHS = [('path', 'path'), ('csum', 'content/csum'), ('size', 'content/size'), ('committed-to-tape', 'content/committed-to-tape')]
+
+try:
+    ## Python 2 zlib does not accept memoryview
+    bufferSlice = buffer
+except NameError:
+    def bufferSlice(data, offset, size):
+        return memoryview(data)[offset:offset + size]
 
 def addToDic(issue, dic):
     if issue in dic:
@@ -65,40 +129,1251 @@ def addToDic(issue, dic):
     else:
         dic[issue] = 1
 
-def appendIssue(issue, new_files, old_files, new, new_dict, old_dict):
-    short_issue = issue.split(': ', 1)[1].split('.', 1)[0]
-    if new:
-        new_files.append(issue)
-        addToDic(short_issue, new_dict)
-    else:
-        old_files.append(issue)
-        addToDic(short_issue, old_dict)
-    return new_files, old_files
+def errorText(err):
+    return "{0}".format(getattr(err, 'output', err)).rstrip()
 
-def appendMessage(verbose, log, log_message, err, err_desc):
+def appendMessage(verbose, log_message, err, err_desc):
     if verbose:
-        err = '. ' + err_desc + ": {0}".format(err.output).rstrip()
-        log_message += err
-    log.append(log_message + '\n')
-    return log
+        log_message += '. ' + err_desc + ": " + errorText(err)
+    return log_message + '\n'
+
+def addTransient(report, verbose, local_path, mtime, err):
+    ## A remote command still failing with a transient error after its retries says nothing about the file itself
+    file_age = 'unknown' if mtime is None else time.ctime(mtime)
+    log_message = local_path + ': archive request failed ' + str(err.attempts) + ' times with a transient error, so the file could not be checked. Try again later or run ' + err.cmd + ' File was last modified on: ' + file_age
+    report.add('problem', local_path, mtime, appendMessage(verbose, log_message, err, "Remote error"), "archive request failed with a transient error", err)
 
 def printErrExit(err, prefix, sub_err, verbose):
     if verbose:
-        err = err + ". {0}".format(sub_err.output).rstrip()
+        err = err + ". {0}".format(getattr(sub_err, 'output', sub_err)).rstrip()
     print(err)
-    with open(prefix + '.tdt', 'w') as f:
+    with textFile(prefix + '.tdt', 'w') as f:
         f.write(err + '\n')
-    exit()
+    sys.exit(2)
+
+def textFile(path, mode, newline=None):
+    ## Python 3 keeps file names that aren't valid in the file system encoding as surrogates, written back as the
+    ## original bytes instead of raising UnicodeEncodeError. Python 2 file names are bytes already
+    if sys.version_info[0] == 2:
+        return open(path, mode)
+    return io.open(path, mode, encoding=sys.getfilesystemencoding(), errors='surrogateescape', newline=newline)
+
+def spoolFile():
+    ## Temporary text file for textFile() lines
+    if sys.version_info[0] == 2:
+        return tempfile.TemporaryFile('w+')
+    return io.TextIOWrapper(tempfile.TemporaryFile('w+b'), encoding=sys.getfilesystemencoding(), errors='surrogateescape')
+
+def atermEscape(token):
+    return token.replace('\\', '\\\\').replace('"', '\\"')
+
+def shellQuote(token):
+    return "'" + token.replace("'", "'\"'\"'") + "'"
+
+class StageTimer(object):
+    ## Context manager timing one call of a stage. Set bytes inside the block to count the bytes it processed
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.stage, time.time() - self.start, self.bytes)
+        return False
+
+class Profiler(object):
+    """
+    Call counts, total time, latency percentiles and bytes processed for each stage of checking files, for --profile.
+    Every latency is kept, as a double in an array, so nothing is recorded unless enabled. Stages can be timed from any thread.
+    """
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stages = []
+        self.latencies = {}
+        self.bytes = {}
+
+    def timer(self, stage):
+        return StageTimer(self, stage)
+
+    def add(self, stage, seconds, nbytes=0):
+        if not self.enabled:
+            return
+        with self.lock:
+            if stage not in self.latencies:
+                self.stages.append(stage)
+                self.latencies[stage] = array.array('d')
+                self.bytes[stage] = 0
+            self.latencies[stage].append(seconds)
+            self.bytes[stage] += nbytes
+
+    def stats(self):
+        ## One dictionary per stage, in the order they were first timed. Percentiles are nearest rank, in milliseconds
+        with self.lock:
+            stats = []
+            for stage in self.stages:
+                latencies = sorted(self.latencies[stage])
+                total = sum(latencies)
+                percentile = lambda fraction: 1000 * latencies[max(0, int(math.ceil(fraction * len(latencies))) - 1)]
+                stat = {'stage': stage, 'calls': len(latencies), 'total_seconds': total, 'mean_ms': 1000 * total / len(latencies),
+                        'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99), 'max_ms': 1000 * latencies[-1]}
+                if self.bytes[stage]:
+                    stat['bytes'] = self.bytes[stage]
+                    stat['mb_per_second'] = self.bytes[stage] / (1024.0 * 1024.0) / max(total, 1e-9)
+                stats.append(stat)
+            return stats
+
+    def write(self, f, files):
+        seconds = time.time() - self.started
+        f.write('\n### Profile ###\n')
+        f.write(str(files) + ' files checked in %.1f seconds, %.1f files/s.\n' % (seconds, files / max(seconds, 1e-9)))
+        f.write('%-24s %10s %10s %10s %10s %10s %10s %10s\n' % ('stage', 'calls', 'total s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'MB/s'))
+        for stat in self.stats():
+            mb_per_second = '%.1f' % stat['mb_per_second'] if 'mb_per_second' in stat else ''
+            f.write('%-24s %10d %10.2f %10.2f %10.2f %10.2f %10.2f %10s\n' % (stat['stage'], stat['calls'], stat['total_seconds'], stat['p50_ms'], stat['p95_ms'], stat['p99_ms'], stat['max_ms'], mb_per_second))
+
+    def dump(self, path, files):
+        seconds = time.time() - self.started
+        with open(path, 'w') as f:
+            json.dump({'files': files, 'seconds': seconds, 'files_per_second': files / max(seconds, 1e-9), 'stages': self.stats()}, f, indent=2)
+
+## Used where no profiler is given
+NO_PROFILER = Profiler(False)
+
+class AtermCrash(Exception):
+    def __init__(self, output):
+        Exception.__init__(self, 'aterm session exited unexpectedly')
+        self.output = output
+
+class AtermError(subprocess.CalledProcessError):
+    """
+    A failed remote command. transient is True for timeouts, crashed sessions and errors matching TRANSIENT_ERRORS,
+    which were retried and may work later, and attempts is the number of times the command was sent. crashed is True
+    if an aterm session exited without a transient error in its output.
+    """
+    def __init__(self, returncode, cmd, output, transient, attempts=1, crashed=False):
+        subprocess.CalledProcessError.__init__(self, returncode, cmd, output)
+        self.transient = transient
+        self.attempts = attempts
+        self.crashed = crashed
+
+class CircuitBreaker(object):
+    """
+    Stops requests to the archive after threshold transient failures in a row, so they wait instead of adding to the
+    load while it is down. After cooldown seconds one request is let through, and the circuit closes again if it works.
+    threshold 0 never opens the circuit.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.trips = 0
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if not self.trial and time.time() - self.opened >= self.cooldown:
+                self.trial = True
+                return True
+            return False
+
+    def wait(self):
+        ## Sleep until allow() lets this request through, for the rest of the cooldown or while a trial request runs
+        while not self.allow():
+            with self.lock:
+                remaining = 0 if self.opened is None else self.opened + self.cooldown - time.time()
+            time.sleep(min(1.0, max(0.05, remaining)))
+
+    def release(self):
+        ## End a trial request that says nothing about the archive, so another one is let through
+        with self.lock:
+            self.trial = False
+
+    def record(self, ok):
+        with self.lock:
+            self.trial = False
+            if ok:
+                self.failures = 0
+                self.opened = None
+                return
+            self.failures += 1
+            if self.opened is not None or (self.threshold > 0 and self.failures >= self.threshold):
+                if self.opened is None:
+                    self.trips += 1
+                    print("Warning: " + str(self.failures) + " archive requests in a row failed, pausing requests for " + str(self.cooldown) + " seconds")
+                self.opened = time.time()
+
+class AtermSession(object):
+    """
+    One long-lived "aterm.jar nogui" process. Commands are written to its stdin, each followed by a
+    sentinel namespace check whose echo marks the end of the reply on stdout.
+    """
+    def __init__(self, java_cmd, profiler=NO_PROFILER):
+        self.java_cmd = java_cmd
+        self.profiler = profiler
+        self.process = None
+        ## Time by which the current reply must have arrived, checked by the watchdog of AtermPool
+        self.deadline = None
+        self.timed_out = False
+
+    def start(self):
+        with self.profiler.timer('aterm start'):
+            ## exec so a timeout kills java rather than the shell
+            self.process = subprocess.Popen('exec ' + self.java_cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            ## Discard the login banner
+            self.send('')
+
+    def close(self):
+        ## Safe to call while another thread is still using the session, e.g. from atexit after --fail_fast stopped
+        process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+        for i in range(20):
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+        else:
+            process.terminate()
+            process.wait()
+
+    def kill(self):
+        process = self.process
+        if process is not None:
+            self.timed_out = True
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+    def send(self, line):
+        lines = []
+        try:
+            if line:
+                self.process.stdin.write(line + '\n')
+            self.process.stdin.write('asset.namespace.exists :namespace "' + ATERM_SENTINEL + '"\n')
+            self.process.stdin.flush()
+            while True:
+                out = self.process.stdout.readline()
+                if not out:
+                    raise AtermCrash(''.join(lines))
+                if ATERM_SENTINEL in out:
+                    return ''.join(lines)
+                lines.append(out)
+        except (IOError, OSError, ValueError, AttributeError):
+            raise AtermCrash(''.join(lines))
+
+    def run(self, line, timeout=0):
+        ## timeout covers starting a new process as well as the reply
+        self.timed_out = False
+        if timeout > 0:
+            self.deadline = time.time() + timeout
+        try:
+            if self.process is None or self.process.poll() is not None:
+                self.close()
+                self.start()
+            return self.send(line)
+        finally:
+            self.deadline = None
+
+class AtermPool(object):
+    """
+    A pool of AtermSession objects that remote commands are routed through, at most max_in_flight at once. With size 0
+    every command launches its own JVM, as before v0.14. Commands taking longer than timeout seconds are killed.
+    Transient failures are retried up to retries times after a random wait of up to retry_delay * 2 ** (attempt - 1)
+    seconds, and the circuit breaker holds requests back while the archive is down, without using up their retries. A
+    crashed session is restarted for the next command, and a command crashing it again is not retried. Failures are raised as AtermError, a subprocess.CalledProcessError like the one-off commands raise.
+    """
+    def __init__(self, config_path, size, profiler=NO_PROFILER, max_in_flight=8, timeout=0, retries=0, retry_delay=1.0, breaker=None):
+        self.java_cmd = 'java -Dmf.cfg=' + os.path.join(config_path, 'config.cfg') + ' -jar ' + os.path.join(config_path, 'aterm.jar') + ' nogui'
+        self.size = size
+        self.profiler = profiler
+        self.slots = threading.Semaphore(max_in_flight)
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.breaker = breaker or CircuitBreaker(0, 0)
+        self.lock = threading.Lock()
+        self.retried = 0
+        self.failed_transient = 0
+        self.sessions = [AtermSession(self.java_cmd, profiler) for i in range(size)]
+        self.idle = queue.Queue()
+        for session in self.sessions:
+            self.idle.put(session)
+        if size > 0 and timeout > 0:
+            thread = threading.Thread(target=self.watchdog)
+            thread.daemon = True
+            thread.start()
+
+    def watchdog(self):
+        ## Kill sessions that are late with their reply, so the waiting command fails as a timeout
+        while True:
+            time.sleep(min(1.0, self.timeout / 2.0))
+            now = time.time()
+            for session in self.sessions:
+                deadline = session.deadline
+                if deadline is not None and now > deadline:
+                    session.kill()
+
+    def describe(self, args):
+        ## The equivalent one-off shell command, for error messages
+        return self.java_cmd + ' ' + ' '.join([token if SAFE_TOKEN.match(token) else shellQuote(atermEscape(token)) for token in args])
+
+    def run(self, args):
+        attempt = 0
+        crashed = False
+        while True:
+            attempt += 1
+            try:
+                if not self.breaker.allow():
+                    with self.profiler.timer('aterm paused'):
+                        self.breaker.wait()
+                try:
+                    with self.slots:
+                        output = self.runOnce(args)
+                except AtermError as err:
+                    if err.crashed:
+                        ## A crash says nothing about the archive, and crashing again points at the command itself
+                        self.breaker.release()
+                        if crashed:
+                            err.transient = False
+                        crashed = True
+                    else:
+                        ## Errors that aren't transient show the archive is responding
+                        self.breaker.record(not err.transient)
+                    raise
+                self.breaker.record(True)
+                return output
+            except AtermError as err:
+                err.attempts = attempt
+                if not err.transient or attempt > self.retries:
+                    if err.transient:
+                        with self.lock:
+                            self.failed_transient += 1
+                    raise
+            with self.lock:
+                self.retried += 1
+            with self.profiler.timer('aterm retry wait'):
+                time.sleep(random.uniform(0, min(MAX_RETRY_DELAY, self.retry_delay * 2 ** (attempt - 1))))
+
+    def runOnce(self, args):
+        cmd = self.describe(args)
+        ## A line break in a token would split the command in a session, so those commands get a JVM of their own
+        if self.size == 0 or [token for token in args if '\n' in token or '\r' in token]:
+            process = subprocess.Popen('exec ' + cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            timer = None
+            if self.timeout > 0:
+                timer = threading.Timer(self.timeout, process.kill)
+                timer.start()
+            try:
+                output = process.communicate()[0]
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            if timer is not None and process.returncode == -9:
+                raise AtermError(process.returncode, cmd, output + 'timed out after ' + str(self.timeout) + ' seconds', True)
+            if process.returncode != 0:
+                raise AtermError(process.returncode, cmd, output, TRANSIENT_ERRORS.search(output) is not None)
+            return output
+        line = ' '.join([token if SAFE_TOKEN.match(token) else '"' + atermEscape(token) + '"' for token in args])
+        with self.profiler.timer('aterm session wait'):
+            session = self.idle.get()
+        try:
+            output = session.run(line, self.timeout)
+        except AtermCrash as err:
+            session.close()
+            if session.timed_out:
+                raise AtermError(1, cmd, err.output + 'timed out after ' + str(self.timeout) + ' seconds', True)
+            raise AtermError(1, cmd, err.output + 'aterm session exited unexpectedly', True, crashed=TRANSIENT_ERRORS.search(err.output) is None)
+        finally:
+            self.idle.put(session)
+        for out in output.splitlines():
+            if out.lstrip('> \t').lower().startswith('error'):
+                raise AtermError(1, cmd, output, TRANSIENT_ERRORS.search(output) is not None)
+        return output
 
-def main(prefix, folder, rdmp_id, config_path, path_subtract, path_add, days_since_backup, verbose):
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+def gf2MatrixTimes(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+def gf2MatrixSquare(mat):
+    return [gf2MatrixTimes(mat, mat[n]) for n in range(32)]
+
+def crc32Combine(crc1, crc2, len2):
+    """
+    CRC32 of two blocks joined together, given the CRC32 of each and the length of the second, as crc32_combine() in zlib.
+    Appending len2 zero bytes to the first block is applied by repeatedly squaring the GF(2) operator for one zero bit.
+    """
+    if len2 == 0:
+        return crc1
+    ## Operator for one zero bit
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    ## Operators for two then four zero bits
+    even = gf2MatrixSquare(odd)
+    odd = gf2MatrixSquare(even)
+    while True:
+        even = gf2MatrixSquare(odd)
+        if len2 & 1:
+            crc1 = gf2MatrixTimes(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = gf2MatrixSquare(even)
+        if len2 & 1:
+            crc1 = gf2MatrixTimes(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+def threadBuffer():
+    if not hasattr(crc_buffers, 'buf'):
+        crc_buffers.buf = bytearray(CRC_BUFFER_SIZE)
+    return crc_buffers.buf
+
+def rangeCrc(local_path, start, end):
+    ## CRC32 of bytes start to end of a file, read through a handle of its own into the thread's buffer
+    buf = threadBuffer()
+    view = memoryview(buf)
+    crc = 0
+    with io.open(local_path, 'rb', buffering=0) as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            n = f.readinto(view[:min(len(buf), end - offset)])
+            if not n:
+                break
+            crc = zlib.crc32(bufferSlice(buf, 0, n), crc)
+            offset += n
+    return crc & 0xffffffff
+
+def localCrc(local_path, large_file_size=None, crc_threads=1):
+    """
+    CRC32 of a local file as upper case hex without leading zeros, as reported in content/csum by the archive.
+    Reads into a reusable per-thread buffer, so a file shrinking while it is read only gives a checksum that doesn't
+    match. Files of at least large_file_size bytes are split into CRC_CHUNK_SIZE ranges that are checksummed by
+    crc_threads threads and combined.
+    """
+    crc = 0
+    with io.open(local_path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if crc_threads > 1 and large_file_size is not None and size >= large_file_size:
+            ranges = [(start, min(start + CRC_CHUNK_SIZE, size)) for start in range(0, size, CRC_CHUNK_SIZE)]
+            pool = ThreadPool(crc_threads)
+            try:
+                crcs = pool.map(lambda r: rangeCrc(local_path, r[0], r[1]), ranges)
+            finally:
+                pool.close()
+                pool.join()
+            for (start, end), chunk_crc in zip(ranges, crcs):
+                crc = crc32Combine(crc, chunk_crc, end - start)
+        else:
+            buf = threadBuffer()
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                crc = zlib.crc32(bufferSlice(buf, 0, n), crc)
+    return '%X' % (crc & 0xffffffff)
+
+def atermValue(line):
+    ## Last double quoted value on a line of aterm output, e.g. '"ABC"' from ':csum -base "16" "ABC"', or None if there
+    ## is none or its closing quote is missing, e.g. as the value continues on the next line
+    value = None
+    i = 0
+    while i < len(line):
+        if line[i] == '"':
+            value = ''
+            i += 1
+            while i < len(line) and line[i] != '"':
+                if line[i] == '\\':
+                    i += 1
+                    if i == len(line):
+                        break
+                value += line[i]
+                i += 1
+            if i >= len(line):
+                return None
+        i += 1
+    return value
+
+def bulkQuery(aterm, where, idx=1, size='infinity'):
+    """
+    Fetch path, checksum, size and tape status of the assets matching an asset.query where clause, from asset idx
+    onwards. Returns a list of dictionaries keyed by the names in BULK_XPATHS. Elements missing from an asset's
+    metadata, or with a value that can't be read, are missing from its dictionary.
+    """
+    args = ['asset.query', ':where', where, ':action', 'get-value', ':size', 'infinity']
+    if size != 'infinity':
+        args[-2:] = [':idx', str(idx), ':size', str(size)]
+    for name, xpath in BULK_XPATHS:
+        args += [':xpath', '-ename', name, xpath]
+    assets = []
+    asset = None
+    for line in aterm.run(args).splitlines():
+        line = line.lstrip('> \t')
+        if line.startswith(':asset'):
+            asset = {}
+            assets.append(asset)
+        elif asset is not None and line.startswith(':'):
+            value = atermValue(line)
+            if value is None:
+                continue
+            asset[line[1:].split(' ', 1)[0]] = value
+    return assets
+
+def listNamespace(aterm, namespace):
+    """
+    Assets directly inside a remote namespace from one query, as a dictionary of bulkQuery() results keyed by filename,
+    and the number of assets left out as their path couldn't be read.
+    """
+    ## The archive has no '//' or trailing '/' in namespaces, as it reports them
+    namespace = normaliseRemote(namespace)
+    listing = {}
+    unnamed = 0
+    for asset in bulkQuery(aterm, "namespace='" + namespace.replace("'", "\\'") + "'"):
+        if 'path' in asset:
+            listing[asset['path'].rsplit('/', 1)[-1]] = asset
+        else:
+            unnamed += 1
+    return listing, unnamed
+
+class FolderListing(object):
+    """
+    Metadata of one remote folder for --bulk, fetched with listNamespace() by whichever remote worker needs it first.
+    get() returns None if the query failed, so its files are checked one at a time. unnamed is the number of assets
+    missing from the listing as their path couldn't be read, so files not in it may still be on the archive.
+    """
+    def __init__(self, aterm, namespace, root):
+        self.aterm = aterm
+        self.namespace = namespace
+        self.root = root
+        self.lock = threading.Lock()
+        self.fetched = False
+        self.listing = None
+        self.unnamed = 0
+
+    def get(self):
+        with self.lock:
+            if not self.fetched:
+                try:
+                    with self.aterm.profiler.timer('remote folder listing'):
+                        self.listing, self.unnamed = listNamespace(self.aterm, self.namespace)
+                except subprocess.CalledProcessError:
+                    print("Warning: listing remote folder of " + self.root + " failed, checking its files one at a time")
+                self.fetched = True
+            return self.listing
+
+def orderedMap(func, items, workers, in_flight):
+    """
+    Generator applying func to items on worker threads, yielding the results in the order of items.
+    At most in_flight items are taken from items before their results are yielded, so memory use is bounded.
+    Exceptions raised by func or by iterating items are raised here.
+    """
+    slots = threading.Semaphore(in_flight)
+    todo = queue.Queue()
+    done = queue.Queue()
+    def feed():
+        count = 0
+        try:
+            for item in items:
+                slots.acquire()
+                todo.put((count, item))
+                count += 1
+        except Exception:
+            done.put((None, False, sys.exc_info()[1]))
+        finally:
+            done.put((None, True, count))
+            for i in range(workers):
+                todo.put(None)
+    def work():
+        while True:
+            job = todo.get()
+            if job is None:
+                return
+            try:
+                done.put((job[0], True, func(job[1])))
+            except Exception:
+                done.put((job[0], False, sys.exc_info()[1]))
+    for target in [feed] + [work] * workers:
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    results = {}
+    total = None
+    i = 0
+    while total is None or i < total:
+        if i in results:
+            ok, result = results.pop(i)
+            slots.release()
+            if not ok:
+                raise result
+            yield result
+            i += 1
+            continue
+        ## Waiting with a timeout keeps Python 2 responsive to Ctrl-C
+        try:
+            index, ok, result = done.get(True, 1)
+        except queue.Empty:
+            continue
+        if index is None:
+            if not ok:
+                raise result
+            total = result
+        else:
+            results[index] = (ok, result)
+
+def scanFolder(path):
+    """
+    List one local folder like os.walk(), returning (path, files, subfolders). files holds (filename, stat) with one stat
+    per file, following symlinks, or the OSError raised by it. Symlinks to folders are skipped, as os.walk() doesn't
+    follow them.
+    """
+    files = []
+    subfolders = []
+    try:
+        if scandir is not None:
+            for entry in scandir(path):
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if not entry.is_symlink():
+                        subfolders.append(entry.name)
+                    continue
+                try:
+                    files.append((entry.name, entry.stat()))
+                except OSError as err:
+                    files.append((entry.name, err))
+        else:
+            for name in os.listdir(path):
+                try:
+                    st = os.stat(os.path.join(path, name))
+                except OSError as err:
+                    files.append((name, err))
+                    continue
+                if not stat.S_ISDIR(st.st_mode):
+                    files.append((name, st))
+                elif not os.path.islink(os.path.join(path, name)):
+                    subfolders.append(name)
+    except OSError as err:
+        print("Warning: listing local folder " + path + " failed: {0}".format(err))
+    return path, files, subfolders
+
+def matchesAny(relative_path, name, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern):
+            return True
+    return False
+
+def isReadable(path, st, uid, groups):
+    ## Whether os.access(path, os.R_OK) is True. The mode bits in the stat decide without another system call when they
+    ## allow reading. Only files they don't allow are passed to os.access(), which also considers ACLs
+    if uid == 0:
+        return True
+    if st.st_uid == uid:
+        readable = st.st_mode & stat.S_IRUSR
+    elif st.st_gid in groups:
+        readable = st.st_mode & stat.S_IRGRP
+    else:
+        readable = st.st_mode & stat.S_IROTH
+    return bool(readable) or os.access(path, os.R_OK)
+
+def walkFiles(folder_abs, path_subtract, remote_folder, aterm, bulk, walk_threads=1, includes=(), excludes=(), profiler=NO_PROFILER, progress=None):
+    """
+    Walk stage: one task per local file, in os.walk() order. The next folders in that order, eight times walk_threads
+    of them, are listed ahead by walk_threads threads with scanFolder(). Only the paths of the others are kept. Each task
+    carries the stat of its file, so later stages make no more local metadata calls.
+    Files are checked if they match any of includes, or includes is empty, and none of excludes. Folders matching
+    excludes are skipped. Patterns are matched against names and paths relative to folder_abs. The files found are
+    reported to progress as each folder is walked.
+    """
+    uid = os.getuid()
+    groups = set(os.getgroups())
+    groups.add(os.getgid())
+    def scan(path):
+        with profiler.timer('walk folder'):
+            return scanFolder(path)
+    pool = ThreadPool(walk_threads)
+    ahead = 8 * walk_threads
+    try:
+        ## Stack of [folder path, listing or None], with the next folder to walk on top
+        pending = [[folder_abs, None]]
+        while pending:
+            ## Start listing the next folders to walk, top first, as the pool lists them in the order they are started
+            for entry in reversed(pending[-ahead:]):
+                if entry[1] is None:
+                    entry[1] = pool.apply_async(scan, (entry[0],))
+            root, files, subfolders = pending.pop()[1].get()
+            relative = root[len(folder_abs):]
+            subfolders = [name for name in subfolders if not matchesAny(os.path.join(relative, name), name, excludes)]
+            pending.extend(reversed([[os.path.join(root, name), None] for name in subfolders]))
+            files = [(filename, st) for filename, st in files if (not includes or matchesAny(os.path.join(relative, filename), filename, includes)) and not matchesAny(os.path.join(relative, filename), filename, excludes)]
+            if progress is not None:
+                progress.found(len(files))
+            path = root[len(path_subtract):]
+            folder = None
+            if bulk and files:
+                folder = FolderListing(aterm, remote_folder + path, root)
+            for filename, st in files:
+                task = {'local_path': os.path.join(root, filename), 'remote_path': remote_folder + path + '/' + filename, 'filename': filename, 'folder': folder}
+                if isinstance(st, OSError):
+                    task['mtime_err'] = st
+                else:
+                    task['stat'] = st
+                    task['mtime'] = st.st_mtime
+                    task['readable'] = isReadable(task['local_path'], st, uid, groups)
+                yield task
+        if progress is not None:
+            progress.walked()
+    finally:
+        pool.terminate()
+
+def remoteSize(output):
+    ## Size in bytes from the content element of asset.get output, or None
+    in_content = False
+    for line in output.splitlines():
+        line = line.strip('> \t')
+        if line.startswith(':content'):
+            in_content = True
+        elif in_content and line.startswith(':size '):
+            try:
+                return int(atermValue(line))
+            except (TypeError, ValueError):
+                return None
+    return None
+
+def describeCommand(aterm, args):
+    ## Command for error messages. Without an AtermPool, when checking against a snapshot, it's only the aterm command
+    return ' '.join(args) if aterm is None else aterm.describe(args)
+
+def fetchOffline(task, aterm, listing):
+    ## Offline status and remote size of one file from its asset metadata, stored in task
+    filename = task['filename']
+    args = ['asset.get', ':id', 'path=' + task['remote_path']]
+    task['offline_cmd'] = describeCommand(aterm, args)
+    try:
+        if listing is None:
+            with aterm.profiler.timer('remote offline status'):
+                task['offline_output'] = aterm.run(args)
+            task['remote_size'] = remoteSize(task['offline_output'])
+            task['offline'] = task['offline_output'].split('committed-to-tape')[1].strip(' "\n')
+        else:
+            task['offline_output'] = str(listing[filename])
+            task['remote_size'] = int(listing[filename]['size']) if 'size' in listing[filename] else None
+            task['offline'] = listing[filename]['committed-to-tape']
+    except subprocess.CalledProcessError as err:
+        task['offline_err'] = err
+    except (IndexError, KeyError, ValueError) as err:
+        task['offline_parse_err'] = err
+
+def fetchRemote(task, aterm, ledger, fail_fast=False, snapshot=None, profiler=NO_PROFILER):
+    """
+    Remote stage: run the archive commands for one file in the order of the checks, storing their outputs, or errors
+    that end the checks, in task. The offline status is fetched before the local checksum is known, so it is also
+    fetched for files whose checksums turn out not to match. Files in the ledger are skipped.
+    With fail_fast the cheapest checks come first: the remote size and tape status are fetched before the checksum,
+    and a file whose size doesn't match or that isn't offline gets an early_issue, so its local copy is never read.
+    With a snapshot, the metadata is looked up in it and no commands are sent to the archive, and aterm may be None.
+    """
+    remote_path = task['remote_path']
+    filename = task['filename']
+    listing = None
+    ## Looked up before the ledger, so files it skips aren't taken as missing locally
+    if snapshot is not None:
+        with profiler.timer('snapshot lookup'):
+            listing = snapshot.lookup(remote_path, filename)
+    if ledger is not None and 'stat' in task:
+        with profiler.timer('ledger lookup'):
+            task['ledger'] = ledger.get(task['local_path'], remote_path, task['stat'])
+        if task['ledger'] == 'skip':
+            return task
+    if listing is None and task['folder'] is not None:
+        listing = task['folder'].get()
+        ## A file missing from a listing that left out assets it couldn't read is checked with its own commands
+        if listing is not None and filename not in listing and task['folder'].unnamed:
+            listing = None
+    ##Note: asset.namespace.exists should technically only be used on folders
+    args = ['asset.namespace.exists', ':namespace', remote_path]
+    task['exists_cmd'] = describeCommand(aterm, args)
+    try:
+        if listing is None:
+            with profiler.timer('remote exists'):
+                aterm.run(args)
+    except subprocess.CalledProcessError as err:
+        task['exists_err'] = err
+        return task
+    if 'mtime_err' in task:
+        return task
+    if fail_fast:
+        fetchOffline(task, aterm, listing)
+        if task.get('remote_size') is not None and task['remote_size'] != task['stat'].st_size:
+            task['early_issue'] = 'file size does not match'
+            return task
+        if task.get('offline') not in (None, 'true'):
+            task['early_issue'] = 'file not offline'
+            return task
+    args = ['asset.get', ':id', 'path=' + remote_path, ':xpath', 'content/csum']
+    cmd = describeCommand(aterm, args)
+    try:
+        if listing is None:
+            with profiler.timer('remote checksum'):
+                task['remote_crc_output'] = aterm.run(args)
+            task['remote_crc'] = task['remote_crc_output'].split('"')[1].upper()
+        elif filename not in listing:
+            raise subprocess.CalledProcessError(1, cmd, 'asset not found in ' + ('snapshot' if snapshot is not None else 'listing of remote folder'))
+        else:
+            task['remote_crc_output'] = str(listing[filename])
+            task['remote_crc'] = listing[filename]['csum'].upper()
+    except subprocess.CalledProcessError as err:
+        task['csum_err'] = err
+        return task
+    except (IndexError, KeyError) as err:
+        task['csum_parse_err'] = err
+        return task
+    if not fail_fast:
+        fetchOffline(task, aterm, listing)
+    return task
+
+def pathBlob(path):
+    ## Paths are stored as bytes, as they may not be valid UTF-8
+    if not isinstance(path, bytes):
+        path = os.fsencode(path)
+    return sqlite3.Binary(path)
+
+class SqliteStore(object):
+    """
+    Base class for state kept in a SQLite file between runs. Writes are buffered and committed in short transactions,
+    so threads of one run and concurrent runs can share the file.
+    """
+    create = ''
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute(self.create)
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.writes = []
+        self.flushed = time.time()
+
+    def query(self, sql, args):
+        ## Called with self.lock held. Errors are treated as nothing found
+        try:
+            return self.connection.execute(sql, args).fetchone()
+        except sqlite3.Error:
+            return None
+
+    def write(self, sql, args):
+        ## Called with self.lock held
+        self.writes.append((sql, args))
+        self.flush(False)
+
+    def flush(self, force):
+        ## Called with self.lock held
+        if not force and len(self.writes) < 1000 and time.time() - self.flushed < 10:
+            return
+        try:
+            for sql, args in self.writes:
+                self.connection.execute(sql, args)
+            self.connection.commit()
+        except sqlite3.Error as err:
+            ## Probably locked by another run for longer than the timeout. Keep the writes and try again later
+            self.connection.rollback()
+            if force:
+                print("Warning: saving to " + self.__class__.__name__ + " failed: {0}".format(err))
+            return
+        self.writes = []
+        self.flushed = time.time()
+
+    def close(self, delete_sql=None, delete_args=()):
+        ## Safe to call more than once, e.g. from atexit after an interrupted run
+        with self.lock:
+            if self.connection is None:
+                return
+            self.flush(True)
+            if delete_sql is not None:
+                try:
+                    self.connection.execute(delete_sql, delete_args)
+                    self.connection.commit()
+                except sqlite3.Error as err:
+                    print("Warning: removing old entries from " + self.__class__.__name__ + " failed: {0}".format(err))
+            self.connection.close()
+            self.connection = None
+
+class CrcCache(SqliteStore):
+    """
+    SQLite file of local CRC32s keyed by (device, inode, size, mtime_ns), so later runs don't read unchanged files again.
+    Entries not used for max_age_days are deleted by close().
+    """
+    create = 'CREATE TABLE IF NOT EXISTS crcs (device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, crc TEXT, last_used REAL, PRIMARY KEY (device, inode, size, mtime_ns))'
+
+    def __init__(self, path):
+        SqliteStore.__init__(self, path)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, st):
+        ## Python 2 has no st_mtime_ns, so derive it from st_mtime under both versions to share the file between them
+        return (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime * 1000000000))
+
+    def get(self, st):
+        key = self.key(st)
+        with self.lock:
+            row = self.query('SELECT crc FROM crcs WHERE device=? AND inode=? AND size=? AND mtime_ns=?', key)
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.write('INSERT OR REPLACE INTO crcs VALUES (?, ?, ?, ?, ?, ?)', key + (row[0], time.time()))
+            return row[0]
+
+    def put(self, st, crc):
+        with self.lock:
+            self.write('INSERT OR REPLACE INTO crcs VALUES (?, ?, ?, ?, ?, ?)', self.key(st) + (crc, time.time()))
+
+    def close(self, max_age_days):
+        SqliteStore.close(self, 'DELETE FROM crcs WHERE last_used < ?', (time.time() - max_age_days * 86400,))
+
+class OfflineLedger(SqliteStore):
+    """
+    SQLite file of files already verified as backed up offline, so later runs skip their remote checks while the local
+    size and modification time are unchanged. Files are saved as they pass, so rerunning an interrupted run carries on
+    from where it stopped. A reverify_fraction of skippable files, picked at random, is checked again anyway. Entries not
+    verified for max_age_days are deleted by close(), so those files are checked again by the next run.
+    """
+    create = 'CREATE TABLE IF NOT EXISTS verified (local_path BLOB PRIMARY KEY, remote_path BLOB, crc TEXT, size INTEGER, mtime_ns INTEGER, verified REAL)'
+
+    def __init__(self, path, reverify_fraction):
+        SqliteStore.__init__(self, path)
+        self.reverify_fraction = reverify_fraction
+        self.skipped = 0
+
+    def get(self, local_path, remote_path, st):
+        ## Returns 'skip' if the file can be skipped, 'recheck' if it has an entry that needs checking again, or None
+        with self.lock:
+            row = self.query('SELECT size, mtime_ns FROM verified WHERE local_path=? AND remote_path=?', (pathBlob(local_path), pathBlob(remote_path)))
+            if row is None:
+                return None
+            if row[0] != st.st_size or row[1] != int(st.st_mtime * 1000000000) or random.random() < self.reverify_fraction:
+                return 'recheck'
+            self.skipped += 1
+            return 'skip'
+
+    def put(self, local_path, remote_path, crc, st):
+        with self.lock:
+            self.write('INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?, ?)', (pathBlob(local_path), pathBlob(remote_path), crc, st.st_size, int(st.st_mtime * 1000000000), time.time()))
+
+    def forget(self, local_path):
+        with self.lock:
+            self.write('DELETE FROM verified WHERE local_path=?', (pathBlob(local_path),))
+
+    def close(self, max_age_days):
+        SqliteStore.close(self, 'DELETE FROM verified WHERE verified < ?', (time.time() - max_age_days * 86400,))
+
+def normaliseRemote(path):
+    ## Remote paths are built with '//' when --path_add is empty, but the archive reports them without
+    return re.sub('/+', '/', path).rstrip('/')
+
+def pathText(blob):
+    ## Inverse of pathBlob()
+    if sys.version_info[0] == 2:
+        return str(blob)
+    return os.fsdecode(bytes(blob))
+
+class Snapshot(SqliteStore):
+    """
+    SQLite file of the metadata of every asset under a remote folder, written by export() in one bulk pass, so local
+    folders inside it can be checked later without contacting the archive. The paths looked up are recorded in a
+    temporary table, and remoteOnly() returns the assets that weren't, which are missing locally.
+    """
+    create = 'CREATE TABLE IF NOT EXISTS assets (path BLOB PRIMARY KEY, csum TEXT, size INTEGER, tape TEXT)'
+
+    def __init__(self, path):
+        SqliteStore.__init__(self, path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TEMP TABLE seen (path BLOB PRIMARY KEY)')
+        self.connection.commit()
+
+    def info(self, name):
+        with self.lock:
+            row = self.query('SELECT value FROM info WHERE name=?', (name,))
+            return None if row is None else row[0]
+
+    def export(self, aterm, root, page_size):
+        """
+        Replace the snapshot with the assets under root, returning how many there are. Assets are fetched into a
+        temporary table first, so a failed export leaves the previous snapshot as it was. unnamed is set to the number
+        of assets left out as their path couldn't be read.
+        """
+        root = normaliseRemote(root)
+        count = 0
+        self.unnamed = 0
+        with self.lock:
+            self.flush(True)
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS exported_assets (path BLOB PRIMARY KEY, csum TEXT, size INTEGER, tape TEXT)')
+            try:
+                while True:
+                    assets = bulkQuery(aterm, "namespace>='" + root.replace("'", "\\'") + "'", count + 1, page_size)
+                    for asset in assets:
+                        if 'path' not in asset:
+                            self.unnamed += 1
+                            continue
+                        self.connection.execute('INSERT OR REPLACE INTO exported_assets VALUES (?, ?, ?, ?)', (pathBlob(asset['path']), asset.get('csum'), asset.get('size'), asset.get('committed-to-tape')))
+                    self.connection.commit()
+                    count += len(assets)
+                    if len(assets) < page_size:
+                        break
+                self.connection.execute('DELETE FROM info')
+                self.connection.execute('DELETE FROM assets')
+                self.connection.execute('INSERT INTO assets SELECT * FROM exported_assets')
+                ## Only a complete export has a root
+                self.connection.execute('INSERT INTO info VALUES (?, ?)', ('root', root))
+                self.connection.execute('INSERT INTO info VALUES (?, ?)', ('exported', str(time.time())))
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                self.connection.execute('DROP TABLE exported_assets')
+                self.connection.commit()
+        return count
+
+    def lookup(self, remote_path, filename):
+        ## Metadata of one asset as a listing for fetchRemote(), which is empty if the asset isn't in the snapshot
+        path = pathBlob(normaliseRemote(remote_path))
+        with self.lock:
+            self.write('INSERT OR IGNORE INTO seen VALUES (?)', (path,))
+            row = self.query('SELECT csum, size, tape FROM assets WHERE path=?', (path,))
+        if row is None:
+            return {}
+        asset = {}
+        for name, value in zip(['csum', 'size', 'committed-to-tape'], row):
+            if value is not None:
+                asset[name] = str(value)
+        return {filename: asset}
+
+    def remoteOnly(self, root):
+        ## Paths of assets under root that weren't looked up, in order. '0' follows '/', so this is a range query
+        root = normaliseRemote(root)
+        with self.lock:
+            self.flush(True)
+            rows = self.connection.execute('SELECT path FROM assets WHERE path >= ? AND path < ? AND path NOT IN (SELECT path FROM seen) ORDER BY path', (pathBlob(root + '/'), pathBlob(root + '0')))
+            for row in rows:
+                yield pathText(row[0])
+
+def selected(relative_path, includes, excludes):
+    ## Whether walkFiles() would check a file at this path relative to its folder
+    parts = relative_path.split('/')
+    for i in range(len(parts)):
+        if matchesAny('/'.join(parts[:i + 1]), parts[i], excludes):
+            return False
+    return not includes or matchesAny(relative_path, parts[-1], includes)
+
+def hashLocal(task, hash_pool, large_file_size, crc_threads, crc_cache, profiler=NO_PROFILER):
+    ## Local stage: check permissions and checksum the local copy of files whose remote checksum was found
+    if 'remote_crc' not in task:
+        return task
+    if task['readable']:
+        try:
+            st = task['stat']
+            if crc_cache is not None:
+                with profiler.timer('crc cache lookup'):
+                    task['local_crc'] = crc_cache.get(st)
+                if task['local_crc'] is not None:
+                    return task
+            with profiler.timer('local checksum') as timer:
+                if hash_pool is None:
+                    task['local_crc'] = localCrc(task['local_path'], large_file_size, crc_threads)
+                else:
+                    task['local_crc'] = hash_pool.apply(localCrc, (task['local_path'], large_file_size, crc_threads))
+                timer.bytes = st.st_size
+            ## Only cache the checksum if the file didn't change while it was read
+            if crc_cache is not None and crc_cache.key(os.stat(task['local_path'])) == crc_cache.key(st):
+                crc_cache.put(st, task['local_crc'])
+        except (IOError, OSError) as err:
+            task['local_crc_err'] = err
+    return task
+
+class Report(object):
+    """
+    Results written as they are found. Every file gets a record in prefix.jsonl or prefix.csv, flushed regularly so a
+    crashed run keeps its results, and the .tdt lines of each section are spooled to a temporary file for copySection().
+    Only the summary counts are kept in memory.
+    """
+    fields = ['path', 'status', 'category', 'issue', 'mtime', 'error', 'message']
+
+    def __init__(self, prefix, report_format):
+        self.report_format = report_format
+        if report_format == 'csv':
+            if sys.version_info[0] == 2:
+                self.records = open(prefix + '.csv', 'wb')
+            else:
+                self.records = textFile(prefix + '.csv', 'w', newline='')
+            self.writer = csv.writer(self.records)
+            self.writer.writerow(self.fields)
+        else:
+            self.records = open(prefix + '.jsonl', 'w')
+        self.sections = dict((category, spoolFile()) for category in ['new', 'old', 'problem', 'remote_only'])
+        self.unflushed = 0
+        self.flushed = time.time()
+        self.passed_counter = 0
+        self.fail_counter = 0
+        self.remote_only_counter = 0
+        self.new_dict = {}
+        self.old_dict = {}
+        self.problem_dict = {}
+
+    def record(self, values):
+        if self.report_format == 'csv':
+            self.writer.writerow(['' if value is None else value for value in values])
+        else:
+            ## Python 2 paths are bytes that may not be valid UTF-8
+            values = [value.decode('utf-8', 'replace') if isinstance(value, bytes) else value for value in values]
+            self.records.write(json.dumps(dict(zip(self.fields, values))) + '\n')
+        self.unflushed += 1
+        if self.unflushed >= 1000 or time.time() - self.flushed >= 10:
+            self.records.flush()
+            self.unflushed = 0
+            self.flushed = time.time()
+
+    def passed(self, path, mtime):
+        self.passed_counter += 1
+        self.record([path, 'passed', '', '', mtime, '', ''])
+
+    def add(self, category, path, mtime, message, issue, err=''):
+        ## category is 'new', 'old' or 'problem', and message the line for the .tdt
+        self.fail_counter += 1
+        addToDic(issue, getattr(self, category + '_dict'))
+        self.sections[category].write(message)
+        self.record([path, 'failed', category, issue, mtime, errorText(err), message.rstrip('\n')])
+
+    def remoteOnly(self, remote_path):
+        ## Files on the archive but not in the local folder don't affect whether it is safe to delete
+        self.remote_only_counter += 1
+        message = remote_path + ': file only on archive, not in local folder.\n'
+        self.sections['remote_only'].write(message)
+        self.record([remote_path, 'remote only', '', 'file only on archive', '', '', message.rstrip('\n')])
+
+    def copySection(self, category, f):
+        section = self.sections[category]
+        section.seek(0)
+        for line in section:
+            f.write(line)
+
+    def close(self):
+        self.records.close()
+        for section in self.sections.values():
+            section.close()
+
+def countFiles(folder_abs, includes=(), excludes=()):
+    ## Number of files walkFiles() will find, listing folders without a stat of every file where scandir is available
+    count = 0
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        path = os.path.join(folder_abs, relative)
+        try:
+            if scandir is not None:
+                entries = [(entry.name, entry.is_dir() and not entry.is_symlink()) for entry in scandir(path)]
+            else:
+                entries = [(name, os.path.isdir(os.path.join(path, name)) and not os.path.islink(os.path.join(path, name))) for name in os.listdir(path)]
+        except OSError:
+            continue
+        for name, is_dir in entries:
+            if matchesAny(os.path.join(relative, name), name, excludes):
+                continue
+            if is_dir:
+                pending.append(os.path.join(relative, name))
+            elif not includes or matchesAny(os.path.join(relative, name), name, includes):
+                count += 1
+    return count
+
+class Progress(object):
+    """
+    Prints a line every interval seconds with the number of files checked, files/s and an ETA. walkFiles() reports the
+    files it finds with found() and the end of the walk with walked(), so the ETA is unknown until every folder is
+    listed. With count_files, the files to check are also counted by countFiles() in a background thread, for an ETA
+    once that finishes. interval 0 prints nothing.
+    """
+    def __init__(self, interval, folder_abs, includes, excludes, count_files=False):
+        self.interval = interval
+        self.started = time.time()
+        self.printed = self.started
+        self.total = None
+        self.files_found = 0
+        self.counting = interval > 0 and count_files
+        if self.counting:
+            thread = threading.Thread(target=self.count, args=(folder_abs, includes, excludes))
+            thread.daemon = True
+            thread.start()
+
+    def count(self, folder_abs, includes, excludes):
+        total = countFiles(folder_abs, includes, excludes)
+        if self.total is None:
+            self.total = total
+
+    def found(self, files):
+        ## Only called by the thread running walkFiles()
+        self.files_found += files
+
+    def walked(self):
+        self.total = self.files_found
+
+    def update(self, checked, failed):
+        now = time.time()
+        if self.interval <= 0 or now - self.printed < self.interval:
+            return
+        self.printed = now
+        rate = checked / max(now - self.started, 1e-9)
+        line = 'Progress: ' + str(checked)
+        if self.total is None:
+            line += ' of at least ' + str(self.files_found)
+            eta = 'unknown, still counting files' if self.counting else 'unknown, still listing folders'
+        else:
+            line += ' of ' + str(self.total)
+            eta = 'unknown' if rate == 0 else str(timedelta(seconds=int(max(0, self.total - checked) / rate)))
+        print(line + ' files checked, ' + str(failed) + ' NOT backed up, %.1f files/s, ETA ' % rate + eta)
+        sys.stdout.flush()
+
+def main(prefix, folder, rdmp_id, config_path, path_subtract, path_add, days_since_backup, verbose, sessions=1, bulk=False, large_file_size=1024, crc_threads=4, remote_workers=1, hash_processes=0, queue_size=100, crc_cache='', use_crc_cache=True, crc_cache_days=90, ledger_path='', use_ledger=True, ledger_days=90, reverify=False, reverify_fraction=0.0, report_format='jsonl', walk_threads=4, includes=None, excludes=None, profile=False, profile_json='', progress_interval=60, count_files=False, fail_fast=False, max_in_flight=8, request_timeout=600, retries=3, retry_delay=1.0, breaker_threshold=10, breaker_cooldown=60, snapshot_path='', export_snapshot=False):
+    """
+    Check every file in folder and write the results to prefix.tdt. Returns True if the folder is backed up and safe to
+    delete. With fail_fast, checking stops at the first file that isn't. With snapshot_path, files are checked against
+    a snapshot of the remote folder, exported first if export_snapshot, without contacting the archive otherwise.
+    """
     sub_err = ''
+    ## Only the snapshot is used if it isn't being exported
+    offline = snapshot_path != '' and not export_snapshot
     ## Check output file can be written to
     try:
         with open(prefix + '.tdt', 'w') as f:
             f.write('')
     except IOError as err:
         print("Error: {0}".format(err))
-        exit()
+        sys.exit(2)
     ## Check python version
     if sys.version_info[0] == 2:
         if sys.version_info[1] < 7 or (sys.version_info[1] == 7 and sys.version_info[2] < 5):
@@ -107,7 +1382,8 @@ def main(prefix, folder, rdmp_id, config_path, path_subtract, path_add, days_sin
     ## Check java installation
     cmd = 'java -version'
     try:
-        subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+        if not offline:
+            subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as sub_err:
         err = 'Error: Java is not installed. If running on kdm.restech.unsw.edu.au, try running "module add unswdataarchive"'
         printErrExit(err, prefix, sub_err, verbose)
@@ -125,223 +1401,328 @@ def main(prefix, folder, rdmp_id, config_path, path_subtract, path_add, days_sin
     if not re.match('D\d{7}', rdmp_id) != None:
         err = 'Error: "' + rdmp_id + '" is not a well formed RDMP ID. It needs to be a "D" followed by seven digits'
         printErrExit(err, prefix, sub_err, verbose)
-    ## Check config_path exists
-    if not os.path.isdir(config_path):
-        err = 'Error: "' + config_path + '" is not an existing folder'
-        printErrExit(err, prefix, sub_err, verbose)
-    ## Check aterm.jar is in config_path
-    if not os.path.isfile(os.path.join(config_path, 'aterm.jar')):
-        err = 'Error: the required aterm.jar file is not present in the folder "' + config_path + '"'
+    ## aterm isn't run offline, so config_path and the files in it are only needed to contact the archive
+    if not offline:
+        ## Check config_path exists
+        if not os.path.isdir(config_path):
+            err = 'Error: "' + config_path + '" is not an existing folder'
+            printErrExit(err, prefix, sub_err, verbose)
+        ## Check aterm.jar is in config_path
+        if not os.path.isfile(os.path.join(config_path, 'aterm.jar')):
+            err = 'Error: the required aterm.jar file is not present in the folder "' + config_path + '"'
+            printErrExit(err, prefix, sub_err, verbose)
+        ## Check config.cfg is in config_path
+        if not os.path.isfile(os.path.join(config_path, 'config.cfg')):
+            err = 'Error: the required config.cfg file is not present in the folder "' + config_path + '"'
+            printErrExit(err, prefix, sub_err, verbose)
+        ## Check aterm.jar permissions
+        if not os.access(os.path.join(config_path, 'aterm.jar'), os.R_OK):
+            err = 'Error: permission denied to read required aterm.jar file'
+            printErrExit(err, prefix, sub_err, verbose)
+        ## Check config.cfg permissions
+        if not os.access(os.path.join(config_path, 'config.cfg'), os.R_OK):
+            err = 'Error: permission denied to read required config.cfg file'
+            printErrExit(err, prefix, sub_err, verbose)
+        ## Check local checksums work
+        try:
+            localCrc(os.path.join(config_path, 'config.cfg'))
+        except (IOError, OSError) as sub_err:
+            err = 'Error: calculating the checksum of config.cfg failed'
+            printErrExit(err, prefix, sub_err, verbose)
+    ## Check large file checksum settings
+    if large_file_size <= 0 or crc_threads < 1:
+        err = 'Error: --large_file_size must be more than 0 and --crc_threads must be at least 1'
         printErrExit(err, prefix, sub_err, verbose)
-    ## Check config.cfg is in config_path
-    if not os.path.isfile(os.path.join(config_path, 'config.cfg')):
-        err = 'Error: the required config.cfg file is not present in the folder "' + config_path + '"'
+    ## Check local checksum cache can be opened
+    cache = None
+    if use_crc_cache:
+        ## Only a cache given with --crc_cache has to open, the default one is skipped if --config_path is read-only
+        crc_cache_given = crc_cache != ''
+        if not crc_cache_given:
+            crc_cache = os.path.join(config_path, 'crc_cache.sqlite')
+        try:
+            cache = CrcCache(crc_cache)
+        except sqlite3.Error as open_err:
+            ## Not named sub_err, which Python 3 unbinds after the except clause
+            if crc_cache_given:
+                err = 'Error: could not open local checksum cache "' + crc_cache + '". Choose another file with --crc_cache or turn it off with --no_crc_cache'
+                printErrExit(err, prefix, open_err, verbose)
+            print("Warning: could not open local checksum cache " + crc_cache + ", running without it: {0}".format(open_err))
+        if cache is not None:
+            atexit.register(cache.close, crc_cache_days)
+    ## Check ledger of files verified offline can be opened
+    ledger = None
+    if not 0 <= reverify_fraction <= 1:
+        err = 'Error: --reverify_fraction must be between 0 and 1'
         printErrExit(err, prefix, sub_err, verbose)
-    ## Check aterm.jar permissions
-    if not os.access(os.path.join(config_path, 'aterm.jar'), os.R_OK):
-        err = 'Error: permission denied to read required aterm.jar file'
+    if use_ledger:
+        ## Like the checksum cache, only a ledger given with --ledger has to open
+        ledger_given = ledger_path != ''
+        if not ledger_given:
+            ledger_path = os.path.join(config_path, 'offline_ledger.sqlite')
+        if reverify:
+            reverify_fraction = 1.0
+        try:
+            ledger = OfflineLedger(ledger_path, reverify_fraction)
+        except sqlite3.Error as open_err:
+            if ledger_given:
+                err = 'Error: could not open ledger of files verified offline "' + ledger_path + '". Choose another file with --ledger or turn it off with --no_ledger'
+                printErrExit(err, prefix, open_err, verbose)
+            print("Warning: could not open ledger of files verified offline " + ledger_path + ", running without it: {0}".format(open_err))
+        if ledger is not None:
+            atexit.register(ledger.close, ledger_days)
+    ## Check snapshot can be opened
+    snapshot = None
+    if export_snapshot and snapshot_path == '':
+        err = 'Error: --export_snapshot needs the file to export to given with --snapshot'
         printErrExit(err, prefix, sub_err, verbose)
-    ## Check config.cfg permissions
-    if not os.access(os.path.join(config_path, 'config.cfg'), os.R_OK):
-        err = 'Error: permission denied to read required config.cfg file'
+    if offline and not os.path.isfile(snapshot_path):
+        err = 'Error: snapshot "' + snapshot_path + '" does not exist. Create it with --export_snapshot'
         printErrExit(err, prefix, sub_err, verbose)
-    ## Check crc32 or equivalent works
-    crc_command = 'crc32'
-    cmd = crc_command + ' "' + os.path.join(config_path, 'config.cfg') + '"'
-    try:
-        local_crc = subprocess.check_output(cmd, shell=True)
-    except subprocess.CalledProcessError:
-        crc_command = 'rhash -C'
-        cmd = crc_command + ' "' + os.path.join(config_path, 'config.cfg') + '"'
+    if snapshot_path != '':
         try:
-            local_crc = subprocess.check_output(cmd, shell=True)
-        except subprocess.CalledProcessError:
-            crc_command = 'cksum -o 3'
-            cmd = crc_command + ' "' + os.path.join(config_path, 'config.cfg') + '"'
-            try:
-                local_crc = subprocess.check_output(cmd, shell=True)
-            except subprocess.CalledProcessError:
-                err = 'Error: "crc32", "rhash -C" and "cksum -o 3" commands all return non-zero exit status. If running on katana, try kdm.restech.unsw.edu.au instead'
-                printErrExit(err, prefix, sub_err, verbose)
-    ## Check remote connection
-    cmd = 'java -Dmf.cfg=' + os.path.join(config_path, 'config.cfg') + ' -jar ' + os.path.join(config_path, 'aterm.jar') + ' nogui asset.namespace.exists :namespace "/"'
-    try:
-        connected = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).rsplit(' ', 1)[1].rstrip()
-    except subprocess.CalledProcessError:
-        connected = '"false"'
-    if connected != '"true"':
-        err = 'Error: Could not connect to UNSW Research Data Store. config.cfg must contain the appropriate password or token. Try running: \'' + cmd + '\''
+            snapshot = Snapshot(snapshot_path)
+        except sqlite3.Error as sub_err:
+            err = 'Error: could not open snapshot "' + snapshot_path + '"'
+            printErrExit(err, prefix, sub_err, verbose)
+        atexit.register(snapshot.close)
+    ## Check number of aterm sessions
+    if sessions < 0:
+        err = 'Error: --sessions must be 0 or more'
         printErrExit(err, prefix, sub_err, verbose)
-    ## Check remote folder exists
-    remote_path = '/UNSW_RDS/' + rdmp_id + '/' + path_add + '/' + folder_abs.replace(path_subtract, '')
-    remote_path = remote_path.replace('\\', '\\\\').replace('"', '\\"').replace("'", "'\"'\"'")
-    cmd = 'java -Dmf.cfg=' + os.path.join(config_path, 'config.cfg') + ' -jar ' + os.path.join(config_path, 'aterm.jar') + ' nogui asset.namespace.exists :namespace \'' + remote_path + '\''
-    try:
-        exists = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).rsplit(' ', 1)[1].rstrip()
-    except subprocess.CalledProcessError:
-        exists = '"false"'
-    if exists != '"true"':
-        err = 'Error: The namespace "' + remote_path + '" does not exist on UNSW Research Data Store. You may need to check your settings of --rdmp_id, --path_subtract and --path_add. Alternatively, this folder may not have been backed up at all yet'
+    ## Check pipeline settings
+    if remote_workers < 1 or hash_processes < 0 or queue_size < 1:
+        err = 'Error: --remote_workers and --queue_size must be at least 1 and --hash_processes must be 0 or more'
+        printErrExit(err, prefix, sub_err, verbose)
+    ## Check progress interval
+    if progress_interval < 0:
+        err = 'Error: --progress_interval must be 0 or more'
         printErrExit(err, prefix, sub_err, verbose)
+    ## Check archive request settings
+    if max_in_flight < 1 or request_timeout < 0 or retries < 0 or retry_delay < 0 or breaker_threshold < 0 or breaker_cooldown < 0:
+        err = 'Error: --max_in_flight must be at least 1 and --request_timeout, --retries, --retry_delay, --breaker_threshold and --breaker_cooldown must be 0 or more'
+        printErrExit(err, prefix, sub_err, verbose)
+    profiler = Profiler(profile or profile_json != '')
+    breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+    remote_path = '/UNSW_RDS/' + rdmp_id + '/' + path_add + '/' + folder_abs.replace(path_subtract, '')
+    aterm = None
+    if not offline:
+        aterm = AtermPool(config_path, sessions, profiler, max_in_flight, request_timeout, retries, retry_delay, breaker)
+        atexit.register(aterm.close)
+        ## Check remote connection
+        args = ['asset.namespace.exists', ':namespace', '/']
+        cmd = aterm.describe(args)
+        try:
+            connected = aterm.run(args).rsplit(' ', 1)[1].rstrip()
+        except subprocess.CalledProcessError:
+            connected = '"false"'
+        if connected != '"true"':
+            err = 'Error: Could not connect to UNSW Research Data Store. config.cfg must contain the appropriate password or token. Try running: \'' + cmd + '\''
+            printErrExit(err, prefix, sub_err, verbose)
+        ## Check remote folder exists
+        try:
+            exists = aterm.run(['asset.namespace.exists', ':namespace', remote_path]).rsplit(' ', 1)[1].rstrip()
+        except subprocess.CalledProcessError:
+            exists = '"false"'
+        if exists != '"true"':
+            err = 'Error: The namespace "' + remote_path + '" does not exist on UNSW Research Data Store. You may need to check your settings of --rdmp_id, --path_subtract and --path_add. Alternatively, this folder may not have been backed up at all yet'
+            printErrExit(err, prefix, sub_err, verbose)
+    ## Export snapshot of remote folder
+    if export_snapshot:
+        print('Exporting snapshot of ' + remote_path + ' to ' + snapshot_path)
+        try:
+            with profiler.timer('snapshot export'):
+                count = snapshot.export(aterm, remote_path, SNAPSHOT_PAGE_SIZE)
+        except (subprocess.CalledProcessError, sqlite3.Error, IndexError) as sub_err:
+            err = 'Error: exporting snapshot of "' + remote_path + '" failed'
+            printErrExit(err, prefix, sub_err, verbose)
+        print('Exported ' + str(count) + ' remote files')
+        if snapshot.unnamed:
+            print('Warning: ' + str(snapshot.unnamed) + ' remote files were left out of the snapshot as their paths could not be read, so their local copies will be reported as not found')
+    ## Check snapshot covers remote folder
+    if snapshot is not None:
+        snapshot_root = snapshot.info('root')
+        snapshot_exported = snapshot.info('exported')
+        if snapshot_root is None:
+            err = 'Error: "' + snapshot_path + '" is not a complete snapshot. Export it again with --export_snapshot'
+            printErrExit(err, prefix, sub_err, verbose)
+        if not (normaliseRemote(remote_path) + '/').startswith(snapshot_root + '/'):
+            err = 'Error: snapshot "' + snapshot_path + '" of "' + snapshot_root + '" does not include "' + remote_path + '"'
+            printErrExit(err, prefix, sub_err, verbose)
     ## Check days_since_backup isn't too big
     try:
         timedelta(days_since_backup)
     except OverflowError as err:
         err = "Error: Problem with --days_since_backup: {0}".format(err)
         printErrExit(err, prefix, sub_err, verbose)
+    ## Check walk settings
+    if walk_threads < 1:
+        err = 'Error: --walk_threads must be at least 1'
+        printErrExit(err, prefix, sub_err, verbose)
+    ## Check report format
+    if report_format not in ['jsonl', 'csv']:
+        err = 'Error: --report_format must be "jsonl" or "csv"'
+        printErrExit(err, prefix, sub_err, verbose)
     ## Check files
-    passed_counter = 0
-    fail_counter = 0
-    new_files = []
-    old_files = []
-    problem_files = []
-    new_dict = {}
-    old_dict = {}
-    problem_dict = {}
-    for root, subfolders, files in os.walk(folder_abs):
-        path = root.replace(path_subtract, '')
-        for filename in files:
-            remote_path = '/UNSW_RDS/' + rdmp_id + '/' + path_add + '/' + path + '/' + filename
-            remote_path = remote_path.replace('\\', '\\\\').replace('"', '\\"').replace("'", "'\"'\"'")
-            ##Note: asset.namespace.exists should technically only be used on folders
-            cmd = 'java -Dmf.cfg=' + os.path.join(config_path, 'config.cfg') + ' -jar ' + os.path.join(config_path, 'aterm.jar') + ' nogui asset.namespace.exists :namespace \'' + remote_path + '\''
-            #print(cmd)
-            try:
-                exists = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as err1:
-                fail_counter += 1
-                local_path = os.path.join(root, filename)
-                err2 = ''
-                try:
-                    file_age = time.ctime(os.path.getmtime(local_path))
-                except OSError as err2:
-                    err2 = "Error with local file: {0}".format(err2)
-                    print(err2)
-                    file_age = 'unknown'
-                log_message = local_path + ': filename caused data archive script to crash. Does it contain non-standard characters? Try running ' + cmd + ' File was last modified on: ' + file_age + err2
-                problem_files = appendMessage(verbose, problem_files, log_message, err1, "Remote file error")
-                addToDic("filename caused data archive script to crash", problem_dict)
+    try:
+        report = Report(prefix, report_format)
+    except IOError as err:
+        print("Error: {0}".format(err))
+        sys.exit(2)
+    ## Remote commands and local checksums run in pipeline stages, and results are merged in walk order
+    hash_pool = None
+    if hash_processes > 0:
+        hash_pool = multiprocessing.Pool(hash_processes)
+    remote_folder = '/UNSW_RDS/' + rdmp_id + '/' + path_add + '/'
+    progress = Progress(progress_interval, folder_abs, includes or [], excludes or [], count_files)
+    tasks = walkFiles(folder_abs, path_subtract, remote_folder, aterm, bulk and snapshot is None, walk_threads, includes or [], excludes or [], profiler, progress)
+    tasks = orderedMap(lambda task: fetchRemote(task, aterm, ledger, fail_fast, snapshot, profiler), tasks, remote_workers, queue_size)
+    tasks = orderedMap(lambda task: hashLocal(task, hash_pool, large_file_size * 1024 * 1024, crc_threads, cache, profiler), tasks, max(1, hash_processes), queue_size)
+    for task in tasks:
+        progress.update(report.passed_counter + report.fail_counter, report.fail_counter)
+        local_path = task['local_path']
+        mtime = task.get('mtime')
+        if task.get('ledger') == 'skip':
+            report.passed(local_path, mtime)
+            continue
+        ## Entries of files that no longer pass are removed from the ledger, and files that pass are saved to it
+        if task.get('ledger') == 'recheck':
+            ledger.forget(local_path)
+        if getattr(task.get('exists_err'), 'transient', False):
+            addTransient(report, verbose, local_path, mtime, task['exists_err'])
+        elif 'exists_err' in task:
+            err2 = ''
+            if 'mtime_err' in task:
+                err2 = "Error with local file: {0}".format(task['mtime_err'])
+                print(err2)
+                file_age = 'unknown'
             else:
-                local_path = os.path.join(root, filename)
-                try:
-                    new = timedelta(seconds=time.time() - os.path.getmtime(local_path)) < timedelta(days_since_backup)
-                    file_age = time.ctime(os.path.getmtime(local_path))
-                except OSError as err:
-                    fail_counter += 1
-                    err = "Error with local file: {0}".format(err)
-                    print(err)
-                    file_age = 'unknown'
-                    problem_files.append(local_path + ': ' + err + ' File was last modified on: unknown.\n')
-                    addToDic("checking age of local file failed", problem_dict)
-                else:
-                    cmd = 'java -Dmf.cfg=' + os.path.join(config_path, 'config.cfg') + ' -jar ' + os.path.join(config_path, 'aterm.jar') + ' nogui asset.get :id path=\'' + remote_path + '\' :xpath "content/csum"'
-                    try:
-                        remote_crc_output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-                        remote_crc = remote_crc_output.split('"')[1].upper()
-                    except subprocess.CalledProcessError as err:
-                        fail_counter += 1
-                        log_message = local_path + ': file not found on archive. File was last modified on: ' + file_age
-                        if verbose:
-                            err = ". Remote file error: {0}".format(err.output).rstrip()
-                            log_message += err
-                        new_files, old_files = appendIssue(log_message + '. \n', new_files, old_files, new, new_dict, old_dict)
-                    except IndexError as err:
-                        fail_counter += 1
-                        log_message = local_path + ': unexpected output for remote checksum. File was last modified on: ' + file_age
-                        err = "{0} ".format(err).rstrip() + remote_crc_output
-                        problem_files = appendMessage(verbose, problem_files, log_message, err, "Remote checksum processing error")
-                        addToDic("unexpected output for remote checksum", problem_dict)
-                    else:
-                        if not os.access(local_path, os.R_OK):
-                            fail_counter += 1
-                            problem_files.append(local_path + ': permission denied for local copy. File was last modified on: ' + file_age + '\n')
-                            addToDic("permission denied for local copy", problem_dict)
-                        else:
-                            #print('remote_crc = ', remote_crc)
-                            cmd = crc_command + ' \'' + local_path.replace("'", "'\"'\"'") + '\''
-                            try:
-                                if crc_command == 'cksum -o 3':
-                                    local_crc = hex(int(subprocess.check_output(cmd, shell=True).split(' ')[0])).rsplit('x')[-1].upper()
-                                elif crc_command == 'crc32':
-                                    local_crc = subprocess.check_output(cmd, shell=True).rstrip().upper().split('\t', 1)[0]
-                                else:
-                                    local_crc = subprocess.check_output(cmd, shell=True).rstrip().upper().rsplit(' ', 1)[-1]
-                            except subprocess.CalledProcessError as err:
-                                ## Checks should prevent this occuring
-                                fail_counter += 1
-                                issue = "calling " + crc_command + " on " + local_path + " failed. Try running: " + cmd
-                                print("Warning: " + issue)
-                                log_message = issue + ' File was last modified on: ' + file_age
-                                problem_files = appendMessage(verbose, problem_files, log_message, err, "Local checksum error")
-                                addToDic("calling " + crc_command + " failed", problem_dict)
-                            else:
-                                #print('local_crc = ', local_crc)
-                                if remote_crc != local_crc and remote_crc != local_crc.lstrip('0') and remote_crc != '0' + local_crc.lstrip('0'):
-                                    fail_counter += 1
-                                    new_files, old_files = appendIssue(local_path + ': file checksum does not match. File was last modified on: ' + file_age + '\n', new_files, old_files, new, new_dict, old_dict)
-                                else:
-                                    cmd = 'java -Dmf.cfg=' + os.path.join(config_path, 'config.cfg') + ' -jar ' + os.path.join(config_path, 'aterm.jar') + ' nogui asset.get :id path=\'' + remote_path + '\''
-                                    #print('cmd =', cmd)
-                                    try:
-                                        offline_output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-                                        offline = offline_output.split('committed-to-tape')[1].strip(' "\n')
-                                    except subprocess.CalledProcessError as err:
-                                        ## Checks should prevent this occuring
-                                        fail_counter += 1
-                                        issue = "checking offline status of " + local_path + " failed. Try running: " + cmd
-                                        print("Warning: " + issue)
-                                        log_message = issue + ' File was last modified on: ' + file_age
-                                        problem_files = appendMessage(verbose, problem_files, log_message, err, "Remote file error")
-                                        addToDic("checking offline status failed", problem_dict)
-                                        continue
-                                    except IndexError as err:
-                                        ## Empty files are never committed to tape and do not have a committed-to-tape label in their metadata
-                                        if remote_crc == '0':
-                                            offline = 'true'
-                                        else:
-                                            ## No known reason for this to occur
-                                            fail_counter += 1
-                                            issue = "processing offline status of " + local_path + " failed. Try running: " + cmd
-                                            print("Warning: " + issue)
-                                            log_message = issue + ' File was last modified on: ' + file_age
-                                            problem_files = appendMessage(verbose, problem_files, log_message, err + ' ' + offline_output, "Error processing offline status")
-                                            addToDic("processing offline status failed", problem_dict)
-                                            continue
-                                    #print('offline =', offline)
-                                    if offline == 'true':
-                                        passed_counter += 1
-                                    else:
-                                        fail_counter += 1
-                                        new_files, old_files = appendIssue(local_path + ': file not offline. File was last modified on: ' + file_age + '\n', new_files, old_files, new, new_dict, old_dict)
-    with open(prefix + '.tdt', 'w') as f:
+                file_age = time.ctime(task['mtime'])
+            log_message = local_path + ': filename caused data archive script to crash. Does it contain non-standard characters? Try running ' + task['exists_cmd'] + ' File was last modified on: ' + file_age + err2
+            report.add('problem', local_path, mtime, appendMessage(verbose, log_message, task['exists_err'], "Remote file error"), "filename caused data archive script to crash", task['exists_err'])
+        elif 'mtime_err' in task:
+            err = "Error with local file: {0}".format(task['mtime_err'])
+            print(err)
+            report.add('problem', local_path, mtime, local_path + ': ' + err + ' File was last modified on: unknown.\n', "checking age of local file failed", task['mtime_err'])
+        else:
+            new = timedelta(seconds=time.time() - task['mtime']) < timedelta(days_since_backup)
+            category = 'new' if new else 'old'
+            file_age = time.ctime(task['mtime'])
+            if 'early_issue' in task:
+                report.add(category, local_path, mtime, local_path + ': ' + task['early_issue'] + '. File was last modified on: ' + file_age + '\n', task['early_issue'])
+            elif getattr(task.get('csum_err'), 'transient', False):
+                addTransient(report, verbose, local_path, mtime, task['csum_err'])
+            elif 'csum_err' in task:
+                log_message = local_path + ': file not found on archive. File was last modified on: ' + file_age
+                if verbose:
+                    err = ". Remote file error: {0}".format(task['csum_err'].output).rstrip()
+                    log_message += err
+                report.add(category, local_path, mtime, log_message + '. \n', "file not found on archive", task['csum_err'])
+            elif 'csum_parse_err' in task:
+                log_message = local_path + ': unexpected output for remote checksum. File was last modified on: ' + file_age
+                err = "{0} ".format(task['csum_parse_err']).rstrip() + task.get('remote_crc_output', '')
+                report.add('problem', local_path, mtime, appendMessage(verbose, log_message, err, "Remote checksum processing error"), "unexpected output for remote checksum", err)
+            elif not task['readable']:
+                report.add('problem', local_path, mtime, local_path + ': permission denied for local copy. File was last modified on: ' + file_age + '\n', "permission denied for local copy")
+            elif 'local_crc_err' in task:
+                ## Checks should prevent this occuring
+                issue = "calculating checksum of " + local_path + " failed."
+                print("Warning: " + issue)
+                log_message = issue + ' File was last modified on: ' + file_age
+                report.add('problem', local_path, mtime, appendMessage(verbose, log_message, task['local_crc_err'], "Local checksum error"), "calculating local checksum failed", task['local_crc_err'])
+            elif task['remote_crc'].lstrip('0') != task['local_crc'].lstrip('0'):
+                report.add(category, local_path, mtime, local_path + ': file checksum does not match. File was last modified on: ' + file_age + '\n', "file checksum does not match")
+            elif getattr(task.get('offline_err'), 'transient', False):
+                addTransient(report, verbose, local_path, mtime, task['offline_err'])
+            elif 'offline_err' in task:
+                ## Checks should prevent this occuring
+                issue = "checking offline status of " + local_path + " failed. Try running: " + task['offline_cmd']
+                print("Warning: " + issue)
+                log_message = issue + ' File was last modified on: ' + file_age
+                report.add('problem', local_path, mtime, appendMessage(verbose, log_message, task['offline_err'], "Remote file error"), "checking offline status failed", task['offline_err'])
+            ## Empty files are never committed to tape and do not have a committed-to-tape label in their metadata
+            elif 'offline_parse_err' in task and task['remote_crc'] != '0':
+                ## No known reason for this to occur
+                issue = "processing offline status of " + local_path + " failed. Try running: " + task['offline_cmd']
+                print("Warning: " + issue)
+                log_message = issue + ' File was last modified on: ' + file_age
+                err = "{0} ".format(task['offline_parse_err']) + task['offline_output']
+                report.add('problem', local_path, mtime, appendMessage(verbose, log_message, err, "Error processing offline status"), "processing offline status failed", err)
+            elif 'offline_parse_err' in task or task['offline'] == 'true':
+                report.passed(local_path, mtime)
+                if ledger is not None:
+                    ledger.put(local_path, task['remote_path'], task['local_crc'], task['stat'])
+            else:
+                report.add(category, local_path, mtime, local_path + ': file not offline. File was last modified on: ' + file_age + '\n', "file not offline")
+        if fail_fast and report.fail_counter > 0:
+            break
+    if hash_pool is not None:
+        if report.fail_counter > 0 and fail_fast:
+            ## Don't wait for checksums of files after the one that failed
+            hash_pool.terminate()
+        else:
+            hash_pool.close()
+        hash_pool.join()
+    if cache is not None:
+        cache.close(crc_cache_days)
+    if ledger is not None:
+        ledger.close(ledger_days)
+    ## Files in the snapshot that no local file was looked up for are only on the archive
+    if snapshot is not None:
+        if not (fail_fast and report.fail_counter > 0):
+            for path in snapshot.remoteOnly(remote_path):
+                if selected(path[len(normaliseRemote(remote_path)) + 1:], includes or [], excludes or []):
+                    report.remoteOnly(path)
+        snapshot.close()
+    with textFile(prefix + '.tdt', 'w') as f:
         f.write('### Files that might have been created or changed since last backup ###\n')
-        for issue in new_files:
-            f.write(issue)
+        report.copySection('new', f)
         f.write('\n### Files that should be backed up based on age since last change ###\n')
-        for issue in old_files:
-            f.write(issue)
+        report.copySection('old', f)
         f.write('\n### Files with other issues ###\n')
-        for issue in problem_files:
-            f.write(issue)
+        report.copySection('problem', f)
+        if snapshot is not None:
+            f.write('\n### Files only on archive ###\n')
+            report.copySection('remote_only', f)
         f.write('\n### Summary ###\n')
-        f.write(str(passed_counter) + ' files are backed up offline and OK to delete.\n')
-        f.write(str(fail_counter) + ' files are NOT backed up offline and NOT OK to delete.\n')
-        if len(new_dict) >= 1:
+        f.write(str(report.passed_counter) + ' files are backed up offline and OK to delete.\n')
+        f.write(str(report.fail_counter) + ' files are NOT backed up offline and NOT OK to delete.\n')
+        if len(report.new_dict) >= 1:
             f.write('\tRecently changed files:\n')
-            for issue in new_dict:
-                f.write('\t\t' + issue + ': ' + str(new_dict[issue]) + '\n')
-        if len(old_dict) >= 1:
+            for issue in report.new_dict:
+                f.write('\t\t' + issue + ': ' + str(report.new_dict[issue]) + '\n')
+        if len(report.old_dict) >= 1:
             f.write('\tOlder files:\n')
-            for issue in old_dict:
-                f.write('\t\t' + issue + ': ' + str(old_dict[issue]) + '\n')
-        if len(problem_dict) >= 1:
+            for issue in report.old_dict:
+                f.write('\t\t' + issue + ': ' + str(report.old_dict[issue]) + '\n')
+        if len(report.problem_dict) >= 1:
             f.write('\tProblem files:\n')
-            for issue in problem_dict:
-                f.write('\t\t' + issue + ': ' + str(problem_dict[issue]) + '\n')
-        if fail_counter == 0:
+            for issue in report.problem_dict:
+                f.write('\t\t' + issue + ': ' + str(report.problem_dict[issue]) + '\n')
+        if cache is not None:
+            f.write('Local checksum cache: ' + str(cache.hits) + ' hits, ' + str(cache.misses) + ' misses.\n')
+        if ledger is not None:
+            f.write('Ledger of files verified offline: ' + str(ledger.skipped) + ' files skipped as already verified.\n')
+        if snapshot is not None and not (fail_fast and report.fail_counter > 0):
+            f.write(str(report.remote_only_counter) + ' files are only on the archive, not in the local folder.\n')
+            f.write('Checked against snapshot of ' + snapshot_root + ' exported on ' + time.ctime(float(snapshot_exported)) + '.\n')
+        if aterm is not None and (aterm.retried or aterm.failed_transient or breaker.trips):
+            f.write('Archive requests: ' + str(aterm.retried) + ' retried, ' + str(aterm.failed_transient) + ' still failing after retries, requests paused ' + str(breaker.trips) + ' times as the archive was not responding.\n')
+        if fail_fast and report.fail_counter > 0:
+            f.write('Stopped at the first file NOT backed up (--fail_fast), so other files were not checked.\n')
+        if report.fail_counter == 0:
             f.write('Folder ' + folder_abs + ' is backed up and safe to delete.\n')
         else:
             f.write('Folder ' + folder_abs + ' is NOT backed up and NOT safe to delete.\n')
+        if profile:
+            profiler.write(f, report.passed_counter + report.fail_counter)
+    if profile_json:
+        try:
+            profiler.dump(profile_json, report.passed_counter + report.fail_counter)
+        except IOError as err:
+            print("Warning: writing profile to " + profile_json + " failed: {0}".format(err))
+    report.close()
+    return report.fail_counter == 0
 
 if __name__ == "__main__":
     from optparse import OptionParser
@@ -353,7 +1734,40 @@ if __name__ == "__main__":
     parser.add_option("--path_add", action="store", type="str", dest="path_add", help="Infix to add to remote path after RDMP ID e.g. 'projects', default=''", default='')
     parser.add_option("--days_since_backup", action="store", type="float", dest="days_since_backup", help="Estimate of the number of days since last back up, default=7", default=7)
     parser.add_option("--verbose", action="store_true", dest="verbose", help="Add full error messages to output", default=False)
+    parser.add_option("--large_file_size", action="store", type="float", dest="large_file_size", help="Size in MB from which files are checksummed in parallel chunks, default=1024", default=1024)
+    parser.add_option("--crc_threads", action="store", type="int", dest="crc_threads", help="Number of threads checksumming each large file, default=4", default=4)
+    parser.add_option("--crc_cache", action="store", type="str", dest="crc_cache", help="SQLite file to cache local checksums in between runs, default='crc_cache.sqlite' in --config_path, used only if it can be opened", default='')
+    parser.add_option("--no_crc_cache", action="store_false", dest="use_crc_cache", help="Don't use the local checksum cache", default=True)
+    parser.add_option("--crc_cache_days", action="store", type="float", dest="crc_cache_days", help="Remove checksums not used for this many days from the cache, default=90", default=90)
+    parser.add_option("--ledger", action="store", type="str", dest="ledger_path", help="SQLite file recording files verified offline, which later runs skip while unchanged, default='offline_ledger.sqlite' in --config_path, used only if it can be opened", default='')
+    parser.add_option("--no_ledger", action="store_false", dest="use_ledger", help="Don't use the ledger of files verified offline", default=True)
+    parser.add_option("--ledger_days", action="store", type="float", dest="ledger_days", help="Remove files not verified for this many days from the ledger, so they are checked again, default=90", default=90)
+    parser.add_option("--reverify", action="store_true", dest="reverify", help="Check all files again, even if the ledger says they are verified offline", default=False)
+    parser.add_option("--reverify_fraction", action="store", type="float", dest="reverify_fraction", help="Fraction of files in the ledger to check again, picked at random, default=0", default=0.0)
+    parser.add_option("--bulk", action="store_true", dest="bulk", help="Fetch remote metadata with one query per folder instead of three commands per file", default=False)
+    parser.add_option("--walk_threads", action="store", type="int", dest="walk_threads", help="Number of threads listing local folders, default=4", default=4)
+    parser.add_option("--include", action="append", type="str", dest="includes", help="Only check files whose name or path relative to folder matches this glob pattern. Can be given more than once")
+    parser.add_option("--exclude", action="append", type="str", dest="excludes", help="Skip files and folders whose name or path relative to folder matches this glob pattern. Can be given more than once")
+    parser.add_option("--remote_workers", action="store", type="int", dest="remote_workers", help="Number of remote commands in flight at once. Use with --sessions of the same number, default=1", default=1)
+    parser.add_option("--hash_processes", action="store", type="int", dest="hash_processes", help="Number of processes calculating local checksums. 0 calculates them in a thread of this process, default=0", default=0)
+    parser.add_option("--queue_size", action="store", type="int", dest="queue_size", help="Maximum number of files waiting in each stage of the pipeline, default=100", default=100)
+    parser.add_option("--report_format", action="store", type="choice", choices=['jsonl', 'csv'], dest="report_format", help="Format of the record of every file written as it is checked to prefix.jsonl or prefix.csv, default='jsonl'", default='jsonl')
+    parser.add_option("--snapshot", action="store", type="str", dest="snapshot_path", help="SQLite snapshot of the remote folder's metadata to check against without contacting the archive, e.g. as exported for a parent folder", default='')
+    parser.add_option("--export_snapshot", action="store_true", dest="export_snapshot", help="Export the remote folder's metadata to --snapshot in one bulk pass first", default=False)
+    parser.add_option("--fail_fast", action="store_true", dest="fail_fast", help="Stop at the first file NOT backed up. Remote size and tape status are checked before reading the local file", default=False)
+    parser.add_option("--max_in_flight", action="store", type="int", dest="max_in_flight", help="Maximum number of archive requests running at once, default=8", default=8)
+    parser.add_option("--request_timeout", action="store", type="float", dest="request_timeout", help="Seconds before an archive request is killed and counted as a transient failure. 0 waits forever, default=600", default=600)
+    parser.add_option("--retries", action="store", type="int", dest="retries", help="Number of times a request failing with a transient error is retried, default=3", default=3)
+    parser.add_option("--retry_delay", action="store", type="float", dest="retry_delay", help="Seconds of exponential backoff before the first retry, doubled for each later one, with random jitter, default=1", default=1.0)
+    parser.add_option("--breaker_threshold", action="store", type="int", dest="breaker_threshold", help="Number of transient failures in a row after which requests are paused. 0 never pauses, default=10", default=10)
+    parser.add_option("--breaker_cooldown", action="store", type="float", dest="breaker_cooldown", help="Seconds requests are paused for before trying the archive again, default=60", default=60)
+    parser.add_option("--profile", action="store_true", dest="profile", help="Add calls, time and latency percentiles of each stage to the .tdt summary", default=False)
+    parser.add_option("--profile_json", action="store", type="str", dest="profile_json", help="Also write the profile of each stage to this JSON file", default='')
+    parser.add_option("--progress_interval", action="store", type="float", dest="progress_interval", help="Seconds between progress lines showing files/s and an ETA. 0 turns them off, default=60", default=60)
+    parser.add_option("--count_files", action="store_true", dest="count_files", help="Count the files to check in a background thread, for an ETA before every folder is listed", default=False)
+    parser.add_option("--sessions", action="store", type="int", dest="sessions", help="Number of long-lived aterm sessions to send remote commands through. 0 launches a new JVM for every command, default=1", default=1)
     (options, args) = parser.parse_args()
     if len(args) != 2:
         parser.error(usage)
-    main(args[0], args[1], options.rdmp_id, options.config_path, options.path_subtract, options.path_add, options.days_since_backup, options.verbose)
+    ## Exit status 0 means the folder is safe to delete, 1 that it isn't and 2 that it couldn't be checked
+    sys.exit(0 if main(args[0], args[1], options.rdmp_id, options.config_path, options.path_subtract, options.path_add, options.days_since_backup, options.verbose, options.sessions, options.bulk, options.large_file_size, options.crc_threads, options.remote_workers, options.hash_processes, options.queue_size, options.crc_cache, options.use_crc_cache, options.crc_cache_days, options.ledger_path, options.use_ledger, options.ledger_days, options.reverify, options.reverify_fraction, options.report_format, options.walk_threads, options.includes, options.excludes, options.profile, options.profile_json, options.progress_interval, options.count_files, options.fail_fast, options.max_in_flight, options.request_timeout, options.retries, options.retry_delay, options.breaker_threshold, options.breaker_cooldown, options.snapshot_path, options.export_snapshot) else 1)
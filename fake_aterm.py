@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for "java -jar aterm.jar nogui", answering the commands check_archived.py sends from a synthetic archive,
+so it can be tested and benchmarked without a connection to the UNSW Data Archive.
+
+Run it through a "java" script earlier on the PATH, e.g. as created by benchmark.py:
+    #!/bin/sh
+    exec python /path/to/fake_aterm.py "$@"
+
+Commands given after "nogui" are run once, otherwise commands are read from stdin like an aterm session.
+Understands:
+    asset.namespace.exists :namespace NAMESPACE
+    asset.get :id path=PATH [:xpath content/csum]
+    asset.query :where namespace='NAMESPACE' :action get-value ... (as sent by --bulk)
+    asset.query :where namespace>='NAMESPACE' :action get-value :idx N :size N ... (as sent by --export_snapshot)
+
+Settings are read from the file given by -Dmf.cfg, one "name=value" per line:
+    fake.manifest   SQLite file of the archive, as made by makeManifest() (required)
+    fake.latency    seconds to wait before each reply, default 0
+    fake.startup    seconds to wait when starting, like JVM startup, default 0
+    fake.failure_rate   fraction of commands that fail with a lost connection error, default 0
+    fake.hang_rate      fraction of commands that never reply, default 0
+    fake.crash_rate     fraction of commands in a session that make the process exit, once for each command, default 0
+    fake.log        file to append one line to for each command, to count remote calls
+
+Change log:
+v0.5 crash a session at most once for each command, as check_archived.py reports commands crashing it again
+v0.4 match asset.query namespaces exactly instead of normalising them
+v0.3 understand namespace>= and paging with :idx and :size in asset.query
+v0.2 failures look like lost connections, so they are retried, added fake.hang_rate
+v0.1 first version
+"""
+
+import re
+import sys
+import time
+import random
+import sqlite3
+
+## Namespace check_archived.py sends after each command in a session
+SENTINEL = '/check_archived_end_of_reply'
+
+def readSettings(argv):
+    settings = {'fake.latency': '0', 'fake.startup': '0', 'fake.failure_rate': '0', 'fake.hang_rate': '0', 'fake.crash_rate': '0', 'fake.log': ''}
+    for arg in argv:
+        if arg.startswith('-Dmf.cfg='):
+            with open(arg[len('-Dmf.cfg='):]) as f:
+                for line in f:
+                    if '=' in line:
+                        name, value = line.split('=', 1)
+                        settings[name.strip()] = value.strip()
+    return settings
+
+def normalise(path):
+    ## check_archived.py joins remote paths with '//' when --path_add is empty
+    path = re.sub('/+', '/', path)
+    if len(path) > 1:
+        path = path.rstrip('/')
+    return path
+
+def makeManifest(manifest_path, assets):
+    """
+    Write the SQLite file of a synthetic archive. assets is an iterable of (remote path, csum, size, committed-to-tape),
+    with committed-to-tape as 'true', 'false' or None for no committed-to-tape element, as for empty files.
+    """
+    connection = sqlite3.connect(manifest_path)
+    connection.execute('CREATE TABLE IF NOT EXISTS assets (path TEXT PRIMARY KEY, namespace TEXT, name TEXT, csum TEXT, size INTEGER, tape TEXT)')
+    connection.execute('CREATE INDEX IF NOT EXISTS assets_namespace ON assets (namespace)')
+    connection.execute('CREATE TABLE IF NOT EXISTS namespaces (namespace TEXT PRIMARY KEY)')
+    namespaces = set(['/'])
+    rows = []
+    for path, csum, size, tape in assets:
+        path = normalise(path)
+        namespace, name = path.rsplit('/', 1)
+        namespace = namespace or '/'
+        rows.append((path, namespace, name, csum, size, tape))
+        while namespace not in namespaces:
+            namespaces.add(namespace)
+            namespace = namespace.rsplit('/', 1)[0] or '/'
+        if len(rows) >= 10000:
+            connection.executemany('INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?, ?)', rows)
+            rows = []
+    connection.executemany('INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?, ?)', rows)
+    connection.executemany('INSERT OR REPLACE INTO namespaces VALUES (?)', [(namespace,) for namespace in namespaces])
+    connection.commit()
+    connection.close()
+
+def quote(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def unescape(token):
+    ## One-off commands arrive with aterm escapes but without the quotes the shell removed
+    return re.sub(r'\\(.)', r'\1', token)
+
+def splitLine(line):
+    ## Split a session command into tokens, removing double quotes and escapes
+    tokens = []
+    for quoted, bare in re.findall(r'"((?:[^"\\]|\\.)*)"|(\S+)', line):
+        if bare:
+            tokens.append(bare)
+        else:
+            tokens.append(unescape(quoted))
+    return tokens
+
+def option(tokens, name):
+    if name in tokens and tokens.index(name) + 1 < len(tokens):
+        return tokens[tokens.index(name) + 1]
+    return None
+
+def assetBlock(row, fields):
+    path, csum, size, tape = row
+    values = {'path': path, 'content/csum': csum, 'content/size': str(size), 'content/committed-to-tape': tape}
+    out = '    :asset -id "1" -version "1"\n'
+    for name, xpath in fields:
+        if values.get(xpath) is not None:
+            out += '        :' + name + ' ' + quote(values[xpath]) + '\n'
+    return out
+
+def runCommand(connection, tokens):
+    ## Returns (exit status, output)
+    if not tokens:
+        return 0, ''
+    service = tokens[0]
+    if service == 'asset.namespace.exists':
+        namespace = option(tokens, ':namespace') or ''
+        found = connection.execute('SELECT 1 FROM namespaces WHERE namespace=?', (normalise(namespace),)).fetchone()
+        return 0, '    :exists -namespace ' + quote(namespace) + ' ' + quote('true' if found else 'false') + '\n'
+    if service == 'asset.get':
+        asset_id = option(tokens, ':id') or ''
+        if not asset_id.startswith('path='):
+            return 1, 'error: executing asset.get: only :id path=... is supported\n'
+        path = normalise(asset_id[len('path='):])
+        row = connection.execute('SELECT path, csum, size, tape FROM assets WHERE path=?', (path,)).fetchone()
+        if row is None:
+            return 1, 'error: executing asset.get: [arc.mf.server.Services$ExServiceError]: call to service \'asset.get\' failed: The asset \'path=' + path + '\' does not exist\n'
+        if option(tokens, ':xpath') == 'content/csum':
+            return 0, '    :value ' + quote(row[1]) + '\n'
+        out = '    :asset -id "1" -version "1"\n        :path ' + quote(row[0]) + '\n        :content\n'
+        out += '            :size ' + quote(str(row[2])) + '\n            :csum -base "16" ' + quote(row[1]) + '\n'
+        if row[3] is not None:
+            out += '            :committed-to-tape ' + quote(row[3]) + '\n'
+        return 0, out
+    if service == 'asset.query':
+        where = option(tokens, ':where') or ''
+        match = re.match(r"namespace(>?=)'((?:[^'\\]|\\.)*)'$", where)
+        if match is None:
+            return 1, 'error: executing asset.query: only :where namespace=\'...\' or namespace>=\'...\' is supported\n'
+        fields = []
+        for i, token in enumerate(tokens):
+            if token == ':xpath' and tokens[i + 1] == '-ename':
+                fields.append((tokens[i + 2], tokens[i + 3]))
+        ## Query namespaces are matched as given, as the archive has no '//' or trailing '/' in them
+        namespace = unescape(match.group(2))
+        if match.group(1) == '=':
+            sql = 'SELECT path, csum, size, tape FROM assets WHERE namespace=? ORDER BY name'
+            args = (namespace,)
+        else:
+            ## The namespace and all namespaces under it
+            sql = 'SELECT path, csum, size, tape FROM assets WHERE namespace=? OR substr(namespace, 1, ?)=? ORDER BY path'
+            args = (namespace, len(namespace.rstrip('/')) + 1, namespace.rstrip('/') + '/')
+        size = option(tokens, ':size') or 'infinity'
+        if size != 'infinity':
+            sql += ' LIMIT ? OFFSET ?'
+            args += (int(size), int(option(tokens, ':idx') or '1') - 1)
+        out = ''
+        for row in connection.execute(sql, args):
+            out += assetBlock(row, fields)
+        return 0, out
+    return 1, 'error: unknown service ' + service + '\n'
+
+def firstCrash(connection, line):
+    ## Whether line hasn't crashed a session before, recorded in the manifest as sessions are separate processes
+    connection.execute('CREATE TABLE IF NOT EXISTS crashes (line TEXT PRIMARY KEY)')
+    try:
+        connection.execute('INSERT INTO crashes VALUES (?)', (line,))
+        connection.commit()
+    except sqlite3.IntegrityError:
+        connection.rollback()
+        return False
+    return True
+
+def main(argv):
+    if argv[:1] == ['-version']:
+        sys.stderr.write('fake_aterm.py stand-in for java\n')
+        return 0
+    settings = readSettings(argv)
+    connection = sqlite3.connect(settings['fake.manifest'])
+    latency = float(settings['fake.latency'])
+    failure_rate = float(settings['fake.failure_rate'])
+    hang_rate = float(settings['fake.hang_rate'])
+    crash_rate = float(settings['fake.crash_rate'])
+    log = None
+    if settings['fake.log']:
+        log = open(settings['fake.log'], 'a')
+    time.sleep(float(settings['fake.startup']))
+    def reply(tokens):
+        if log is not None:
+            log.write(' '.join(tokens[:3]) + '\n')
+            log.flush()
+        time.sleep(latency)
+        ## Never fail the check_archived.py end of reply marker, which a session would wait for forever
+        if tokens and SENTINEL not in tokens:
+            if random.random() < hang_rate:
+                time.sleep(86400)
+            if random.random() < failure_rate:
+                return 1, 'error: connection lost (simulated failure)\n'
+        return runCommand(connection, tokens)
+    if 'nogui' in argv and argv.index('nogui') + 1 < len(argv):
+        status, out = reply([unescape(token) for token in argv[argv.index('nogui') + 1:]])
+        sys.stdout.write(out)
+        return status
+    sys.stdout.write('Connected to fake archive\n')
+    sys.stdout.flush()
+    for line in iter(sys.stdin.readline, ''):
+        tokens = splitLine(line.strip())
+        if tokens and SENTINEL not in tokens and random.random() < crash_rate and firstCrash(connection, line.strip()):
+            return 1
+        status, out = reply(tokens)
+        sys.stdout.write(out)
+        sys.stdout.flush()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))